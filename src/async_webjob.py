@@ -1,3 +1,4 @@
+import math
 import os
 import time
 import io
@@ -6,36 +7,91 @@ import asyncio
 from single_character import single_character_azure
 from multi_character import multi_character_azure
 from azure.servicebus.aio import ServiceBusClient, AutoLockRenewer
-from azure.servicebus import ServiceBusReceiveMode
+from azure.servicebus import ServiceBusMessage, ServiceBusReceiveMode
 from datetime import datetime
-from azure.storage.blob import BlobServiceClient
-from azure.cosmos import CosmosClient
 from langchain.schema import SystemMessage, HumanMessage
-from langchain_openai import AzureChatOpenAI
 import base64
-from azure.core import MatchConditions
-from PIL import Image
-from functools import reduce
+from functools import partial, reduce
+from PIL import UnidentifiedImageError
 from logging_utility import log_function
+from dedup import FULL_BOOK, PREVIEW, DedupIndex, job_key
+from cosmos_store import PreviewSession, close_client, get_container, read_book
+from blob_store import close_blob_service, download
+from template_cache import TemplateCache
+from description_cache import DescriptionCache
+from worker_pool import WorkerPool
+from telemetry import close_telemetry, report_charge
+from openai_clients import registry as openai_clients
+from image_executor import run_image, shutdown_executor
+from pdf_writer import (
+    BlobSink,
+    PdfWriter,
+    blob_page,
+    encode_pdf_page,
+    write_pdf,
+)
+from reference_images import mime_type, normalize_reference
+from upload_manager import uploads
 
 
 CONNECTION_STR = os.environ["SERVICE_BUS"]
 QUEUE_NAME = "queue"  # fallback default
-CONCURRENCY = int(os.getenv("WORKERS", "1"))   # parallel workers
+CONCURRENCY = int(os.getenv("WORKERS", "20"))   # parallel jobs
+RECEIVERS = int(os.getenv("RECEIVERS", "1"))
+RECEIVE_BATCH = int(os.getenv("RECEIVE_BATCH", "10"))
+POOL_REPORT_SECS = float(os.getenv("POOL_REPORT_SECS", "60"))
 LOCK_RENEW_SECS = int(os.getenv("LOCK_RENEW_SECS", "300"))
-preview_ids = []
+# Upper bound for one page, including the relaxed-prompt retry
+PAGE_LOCK_SECS = int(os.getenv("PAGE_LOCK_SECS", "1200"))
+BATCH_DESCRIPTIONS = os.getenv("BATCH_DESCRIPTIONS", "1") == "1"
+FULL_BOOK_PDF = os.getenv("FULL_BOOK_PDF", "1") == "1"
+# Failed jobs go back to the dispatcher for a fresh reservation
+REDISPATCH_QUEUE = os.getenv("REDISPATCH_QUEUE", "handle_rate")
+JOB_RETRIES = int(os.getenv("JOB_RETRIES", "2"))
+NON_RETRYABLE_STATUS = (400, 401, 404)
+PDF_RETRIES = int(os.getenv("PDF_RETRIES", "3"))
+PDF_BACKOFF_SECS = float(os.getenv("PDF_BACKOFF_SECS", "2"))
+# Created in main(): spawned image workers re-import the launched script
+# and must not open these stores again
+dedup = None
+template_cache = None
+description_cache = None
+
+
+async def images_to_pdf(list):
+
+    # One page is decoded at a time, in the image executor
+    writer = PdfWriter()
+    pdf_buffer = io.BytesIO()
+    pdf_buffer.write(writer.header())
+    for b in list:
+        page = await run_image(encode_pdf_page, b.read())
+        pdf_buffer.write(writer.page(*page))
+    pdf_buffer.write(writer.trailer())
 
+    return pdf_buffer
 
-def images_to_pdf(list):
 
-    images = [Image.open(b).convert("RGB") for b in list]
+async def book_pdf(pages, blob_name):
 
-    pdf_buffer = io.BytesIO()
-    images[0].save(
-        pdf_buffer, format="PDF", save_all=True, append_images=images[1:]
-    )
+    # Streams the uploaded pages back into one PDF blob, page by page. The
+    # pages are already stored, so a failure is retried here and never
+    # fails the job into re-rendering them
+    for attempt in range(PDF_RETRIES):
+        try:
+            count = await write_pdf(
+                [blob_page(page.container, page.name) for page in pages],
+                BlobSink("final-books", blob_name),
+            )
+        except Exception as e:
+            log_function(f"PDF attempt {attempt + 1}: {blob_name}: {e}")
+            if attempt < PDF_RETRIES - 1:
+                await asyncio.sleep(PDF_BACKOFF_SECS * 2 ** attempt)
+        else:
+            log_function(f"Wrote {count} page PDF: {blob_name}")
+            return True
 
-    return pdf_buffer
+    return False
 
 
 def replace_text(list, characters):
@@ -89,42 +145,50 @@ Return only the sentence.
     return prompt
 
 
-async def user_description(image):
-
-    base64_image = base64.b64encode(image.read()).decode('utf-8')
-    name = image.name
-
-    mime_type = "image/png" if name.lower().endswith(".png") else "image/jpeg"
-
-    # Create data URL for the image
-    data_url = f"data:{mime_type};base64,{base64_image}"
-    api_base = os.environ["gpt_4o_mini_openai_api_endpoint"]
-    api_key = os.environ["gpt_4o_mini_openai_api_key"]
-    deployment_name = os.environ["gpt_4o_mini_model_deployment_name"]
-    api_version = "2025-04-01-preview"
+def description_client():
 
-    client = AzureChatOpenAI(
-        deployment_name=deployment_name,
-        model_name=deployment_name,
-        openai_api_key=api_key,
-        openai_api_version=api_version,
-        azure_endpoint=api_base,
+    return openai_clients.chat_client(
+        os.environ["gpt_4o_mini_openai_api_endpoint"],
+        os.environ["gpt_4o_mini_openai_api_key"],
+        os.environ["gpt_4o_mini_model_deployment_name"],
         timeout=30,
         max_retries=0,
     )
 
-    sys = SystemMessage(content=await get_prompt())
+
+def image_data_url(image_bytes):
+
+    base64_image = base64.b64encode(image_bytes).decode('utf-8')
+
+    return f"data:{mime_type(image_bytes)};base64,{base64_image}"
+
+
+async def user_description(image, lookup=True):
+
+    # getvalue() leaves the stream position alone for the later image edit
+    image_bytes = image.getvalue()
+    prompt = await get_prompt()
+    if lookup:
+        cached = await description_cache.get(image_bytes, prompt)
+        if cached is not None:
+            return cached
+
+    sys = SystemMessage(content=prompt)
     des = "Generate a detailed description of the image"
     msg = HumanMessage(
         content=[
             {"type": "text", "text": des},
-            {"type": "image_url", "image_url": {"url": data_url}}
+            {
+                "type": "image_url",
+                "image_url": {"url": image_data_url(image_bytes)}
+            }
         ]
     )
 
     try:
 
-        response = await client.ainvoke([sys, msg])
+        response = await description_client().ainvoke([sys, msg])
+        await description_cache.set(image_bytes, prompt, response.content)
         return response.content
 
     except Exception as e:
@@ -133,92 +197,120 @@ async def user_description(image):
         return "Unable to generate"
 
 
-async def book_data_cosmos(book_id, books_container):
-
-    log_function("Inside book")
-    data = books_container.read_item(book_id, book_id)
-    log_function("got book")
-    return data
+def parse_batch_descriptions(content, keys):
 
+    text = content.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find("{"):]
 
-async def preview_dat(preview_id, container):
+    parsed = json.loads(text)
+    return {
+        key: parsed[key].strip()
+        for key in keys
+        if isinstance(parsed.get(key), str) and parsed[key].strip()
+    }
 
-    query = f"SELECT * FROM c WHERE c.id='{preview_id}'"
 
-    data = list(
-        container.query_items(
-            query=query,
-            enable_cross_partition_query=True,
-        )
-    )[0]
+async def batch_user_descriptions(images):
+
+    prompt = await get_prompt()
+    descriptions = {}
+    pending = {}
+
+    for key, image in images.items():
+        cached = await description_cache.get(image.getvalue(), prompt)
+        if cached is not None:
+            descriptions[key] = cached
+        else:
+            pending[key] = image
+
+    if len(pending) > 1 and BATCH_DESCRIPTIONS:
+        content = [{
+            "type": "text",
+            "text": (
+                f"You will receive {len(pending)} reference portraits, each "
+                "preceded by its key. Follow the instructions for each "
+                "portrait independently. Return only a JSON object mapping "
+                "every key to its sentence."
+            ),
+        }]
+        for key, image in pending.items():
+            content.append({"type": "text", "text": f"Portrait key: {key}"})
+            content.append({
+                "type": "image_url",
+                "image_url": {"url": image_data_url(image.getvalue())},
+            })
+
+        try:
+            response = await description_client().bind(
+                response_format={"type": "json_object"}
+            ).ainvoke([SystemMessage(content=prompt), HumanMessage(content)])
+            parsed = parse_batch_descriptions(response.content, pending)
+        except Exception as e:
+            log_function(e)
+            parsed = {}
+
+        for key, description in parsed.items():
+            descriptions[key] = description
+            await description_cache.set(
+                pending.pop(key).getvalue(), prompt, description
+            )
 
-    return data
+        if pending:
+            log_function(f"Batch description missed {list(pending)}")
 
+    # Anything the batch could not answer falls back to one call per photo;
+    # these already missed the cache above
+    fallback = await asyncio.gather(
+        *(user_description(image, False) for image in pending.values())
+    )
+    descriptions.update(zip(pending, fallback))
 
-async def modify_start_time(preview_id, container, endpoint_1, endpoint_2):
+    return descriptions
 
-    query = f"SELECT * FROM c WHERE c.id='{preview_id}'"
 
-    data = list(
-        container.query_items(
-            query=query,
-            enable_cross_partition_query=True,
-        )
-    )[0]
-    data["start_time"] = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    data["status"] = "in progress"
-    data["deployment_1"] = endpoint_1
-    data["deployment_2"] = endpoint_2
-    container.replace_item(
-        item=preview_id,
-        body=data,
-        etag=data["_etag"],
-        match_condition=MatchConditions.IfNotModified,
-    )
+async def book_data_cosmos(book_id, books_container):
 
+    log_function("Inside book")
+    data = await read_book(books_container, book_id)
+    log_function("got book")
     return data
 
 
-async def modify_end_time(preview_id, container):
-
-    query = f"SELECT * FROM c WHERE c.id='{preview_id}'"
+async def modify_start_time(session, endpoint_1, endpoint_2, mode=PREVIEW):
 
-    data = list(
-        container.query_items(
-            query=query,
-            enable_cross_partition_query=True,
+    now = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    if mode == FULL_BOOK:
+        # Keep the preview's own timings and status intact
+        session.set(book_start_time=now, book_status="in progress")
+    else:
+        session.set(
+            start_time=now,
+            status="in progress",
+            deployment_1=endpoint_1,
+            deployment_2=endpoint_2,
         )
-    )[0]
-    data["end_time"] = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    data["status"] = "completed"
-    container.replace_item(
-        item=preview_id,
-        body=data,
-        etag=data["_etag"],
-        match_condition=MatchConditions.IfNotModified,
-    )
+    await session.flush()
 
-    return data
 
+async def modify_end_time(session, mode=PREVIEW):
 
-async def preview_data_cosmos(preview_id, container, user_desc):
+    now = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    if mode == FULL_BOOK:
+        session.set(book_end_time=now, book_status="completed")
+    else:
+        session.set(end_time=now, status="completed")
+    await session.flush()
 
-    query = f"SELECT * FROM c WHERE c.id='{preview_id}'"
 
-    data = list(
-        container.query_items(
-            query=query,
-            enable_cross_partition_query=True,
-        )
-    )[0]
-    data["user_description"] = user_desc
-    container.replace_item(
-        item=preview_id,
-        body=data,
-        etag=data["_etag"],
-        match_condition=MatchConditions.IfNotModified,
-    )
-    return data
+async def preview_data_cosmos(session, user_desc, mode=PREVIEW):
+
+    # Buffered, written with the next flush
+    if mode == FULL_BOOK:
+        session.set(book_user_description=user_desc)
+    else:
+        session.set(user_description=user_desc)
 
 
 async def simulate_image_generation(data):
@@ -230,136 +322,109 @@ async def simulate_image_generation(data):
 async def process_message(json_data, worker_name: str):
 
     preview_id = json_data["data"]
-    client = CosmosClient(
-        os.environ["cosmos_db_url"],
-        os.environ["cosmos_db_key"]
-    )
-    container = (
-        client.get_database_client("storybook_db")
-        .get_container_client("previews_container")
-    )
-    books_container = (
-        client.get_database_client("storybook_db")
-        .get_container_client("books_container")
-    )
+    container = get_container("previews_container")
+    books_container = get_container("books_container")
     log_function(f"Processing: {preview_id}")
+    mode = json_data.get("mode", PREVIEW)
     deployment_1 = json_data.get("deployment_1")
-    deployment_2 = json_data.get("deployment_1")
+    deployment_2 = json_data.get("deployment_2") or deployment_1
+    # Every deployment the dispatcher reserved for this job
+    deployments = json_data.get("deployments") or [deployment_1, deployment_2]
     quality = json_data.get("quality")
-    deployments = iter([deployment_1, deployment_2])
-    await modify_start_time(preview_id, container, deployment_1.get("deployment-name"), deployment_2.get("deployment-name"))
+    session = await PreviewSession.open(container, preview_id)
+    await modify_start_time(
+        session,
+        deployment_1.get("deployment-name"),
+        deployment_2.get("deployment-name"),
+        mode,
+    )
 
     start = time.time()
+    tasks = []
 
     try:
         log_function(f"Started job: {worker_name}")
-        blob_client = BlobServiceClient.from_connection_string(
-            os.environ["connection_string"]
-        )
-        log_function("Getting preview data")
-        book_data = await preview_dat(preview_id, container)
+        book_data = session.data
         book_id = book_data["bookId"]
         gender = book_data["variant"]
         user_data = book_data["characters"]
         user_id = book_data["ownerId"]
         log_function(book_data)
-        log_function("Getting book data")
-        book_data = await book_data_cosmos(book_id, books_container)
 
         log_function("Getting user images")
-        user_images_task = asyncio.create_task(
-            get_user_image_desc(user_data, blob_client)
+        user_image_tasks = get_user_images(user_data)
+        tasks.extend(user_image_tasks.values())
+        descriptions_task = asyncio.create_task(
+            get_user_desc(user_image_tasks)
         )
-        user_images = None
-        descriptions = {}
-
-        image_tasks = []
-        text = []
-        count = 0
-        stit = []
-
-        for _ in book_data["metaData"]["preview_pages"]:
-
-            path = book_data["pages"][_ - 1]["images"][gender]
-            log_function("Getting template image")
-            template_image = await get_image(path, blob_client)
-
-            if not user_images:
-                user_images, descriptions = await user_images_task
-
-            log_function("Received user image and description")
-            user_img = [
-                user_images[key]
-                for key in book_data["pages"][_ - 1]["character_data"]
-                [gender].keys()
-            ]
-            stit.append(template_image)
-            images = [template_image] + user_img
-
-            user_desc = [
-                f"* {key}: " + descriptions[key]
-                for key in book_data["pages"][_ - 1]["character_data"]
-                [gender].keys()
-            ]
-
-            await preview_data_cosmos(preview_id, container, str(user_desc))
-            new_text = replace_text([book_data["pages"][_ - 1]["text"]], user_data)[0]
-            text.append(book_data["pages"][_ - 1]["text"])
-            desc = [
-                book_data["pages"][_ - 1]["vision_description"].get(gender)
-            ]
-            description = desc + user_desc
-            deployment = next(deployments)
-
-            if len(images) == 2:
-
-                data = {
-                    "page_num": _,
-                    "preview_id": preview_id,
-                    "book_id": book_id,
-                    "user_id": user_id,
-                    "images": images,
-                    "description": description,
-                    "text": new_text,
-                    "gender": gender,
-                    "deployment": deployment,
-                    "quality": quality
-                }
-
-                log_function("Sending to swap")
-                image_tasks.append(single_character_azure(data))
-
-            else:
-
-                data = {
-                    "page_num": _,
-                    "preview_id": preview_id,
-                    "book_id": book_id,
-                    "user_id": user_id,
-                    "images": images,
-                    "description": description,
-                    "text": new_text,
-                    "gender": gender,
-                    "deployment": deployment,
-                    "quality": quality
-                }
-                log_function("Sending to swap")
-                image_tasks.append(multi_character_azure(data))
-            count += 1
+        tasks.append(descriptions_task)
 
-    except Exception as e:
+        log_function("Getting book data")
+        book_data = await book_data_cosmos(book_id, books_container)
+        if mode == FULL_BOOK:
+            page_numbers = list(range(1, len(book_data["pages"]) + 1))
+        else:
+            page_numbers = book_data["metaData"]["preview_pages"]
+        log_function(
+            f"Rendering {len(page_numbers)} pages on "
+            f"{len(deployments)} deployments"
+        )
 
-        log_function(e)
-        log_function("Nope")
-        raise
+        # Every page runs as soon as its own inputs are in, so a finished
+        # page stitches and uploads while the others are still generating;
+        # a reserved slot serves one page at a time, pages beyond the
+        # reservation wait for the page ahead of them on their slot
+        slots = [asyncio.Semaphore(1) for _ in deployments]
+        page_tasks = []
+        for i, _ in enumerate(page_numbers):
+            template_task = asyncio.create_task(
+                get_image(book_data["pages"][_ - 1]["images"][gender])
+            )
+            tasks.append(template_task)
+            data = {
+                "page_num": _,
+                "preview_id": preview_id,
+                "book_id": book_id,
+                "user_id": user_id,
+                "text": replace_text(
+                    [book_data["pages"][_ - 1]["text"]], user_data
+                )[0],
+                "gender": gender,
+                "deployment": deployments[i % len(slots)],
+                "quality": quality,
+            }
+            page_tasks.append(asyncio.create_task(generate_page(
+                data,
+                book_data["pages"][_ - 1],
+                template_task,
+                user_image_tasks,
+                descriptions_task,
+                slots[i % len(slots)],
+                i >= len(slots),
+            )))
+        tasks.extend(page_tasks)
+
+        last_keys = book_data["pages"][page_numbers[-1] - 1][
+            "character_data"][gender].keys()
+        record_task = asyncio.create_task(
+            record_descriptions(session, last_keys, descriptions_task, mode)
+        )
+        tasks.append(record_task)
 
-    try:
-        images = await asyncio.gather(*image_tasks)
+        images = await asyncio.gather(*page_tasks)
+        await record_task
         if None in images:
             raise
 
+        # The preview is only completed once every page is in storage
+        await asyncio.gather(*(image.uploaded for image in images))
+
     except Exception as e:
+
         log_function(e)
+        log_function("Nope")
+        for task in tasks:
+            task.cancel()
         raise
 
     log_function("Received images")
@@ -367,44 +432,110 @@ async def process_message(json_data, worker_name: str):
     if len(images) == 0:
         return None
 
+    if mode == FULL_BOOK and FULL_BOOK_PDF:
+        await book_pdf(images, f"{user_id}/{preview_id}/{book_id}/book.pdf")
+
     log_function(f"Completed job: {worker_name}")
     end = time.time()
-    await modify_end_time(preview_id, container)
-    global preview_ids
-    preview_ids.remove(preview_id)
+    await modify_end_time(session, mode)
     log_function(f"Time Taken: {end - start}")
+    log_function(template_cache.summary())
+    log_function(
+        f"Description cache: {description_cache.hits} hits, "
+        f"{description_cache.misses} misses"
+    )
+
+
+def page_description(keys, descriptions):
+
+    return [f"* {key}: " + descriptions[key] for key in keys]
+
+
+def own_copy(image):
+
+    # Portraits are shared by every page of the job; each upload reads
+    # from its own stream position
+    copy = io.BytesIO(image.getvalue())
+    copy.name = image.name
+
+    return copy
 
 
-async def get_user_image_desc(user_data, blob_client):
+async def generate_page(data, page, template_task, user_image_tasks,
+                        descriptions_task, slot, extra=False):
+
+    gender = data["gender"]
+    keys = page["character_data"][gender].keys()
+
+    template_image = await template_task
+    user_img = await asyncio.gather(*(user_image_tasks[key] for key in keys))
+    descriptions = await descriptions_task
+    log_function(f"Page {data['page_num']} inputs ready")
+
+    data["images"] = [template_image] + [own_copy(_) for _ in user_img]
+    data["description"] = [
+        page["vision_description"].get(gender)
+    ] + page_description(keys, descriptions)
+
+    async with slot:
+        if extra:
+            report_charge(data["deployment"]["deployment-name"])
+        log_function("Sending to swap")
+        if len(data["images"]) == 2:
+            return await single_character_azure(data)
+
+        return await multi_character_azure(data)
+
+
+async def record_descriptions(session, keys, descriptions_task,
+                              mode=PREVIEW):
+
+    descriptions = await descriptions_task
+    await preview_data_cosmos(
+        session, str(page_description(keys, descriptions)), mode
+    )
+    await session.flush()
+
+
+def get_user_images(user_data):
 
     tmp = "https://storyverseblobstorage.blob.core.windows.net/user-photos/"
     urls = [_["photoUrl"][len(tmp):] for _ in user_data]
     log_function(str(urls))
 
-    image_task = [get_image(_, blob_client, "user-photos") for _ in urls]
-    images = await asyncio.gather(*image_task)
-    description_task = [user_description(_) for _ in images]
-    descriptions = await asyncio.gather(*description_task)
-
-    images = {
-        _["key"]: images[i] for i, _ in enumerate(user_data)
-    }
-    descriptions = {
-        _["key"]: descriptions[i]
+    return {
+        _["key"]: asyncio.create_task(get_reference_image(urls[i]))
         for i, _ in enumerate(user_data)
     }
 
-    return images, descriptions
 
+async def get_user_desc(user_image_tasks):
 
-async def get_image(blob_path, blob_client, container_name="books"):
+    images = dict(zip(
+        user_image_tasks,
+        await asyncio.gather(*user_image_tasks.values()),
+    ))
 
-    blob_service_client = blob_client.get_blob_client(
-        container_name, blob_path
-    )
+    return await batch_user_descriptions(images)
+
+
+async def get_reference_image(blob_path):
+
+    # Normalized once, the same bytes feed the description and the edit
+    data = await download("user-photos", blob_path)
+    data, extension = await run_image(normalize_reference, data)
+    image = io.BytesIO(data)
+    image.name = f"reference_image.{extension}"
 
-    blob = blob_service_client.download_blob()
-    image = blob.readall()
+    return image
+
+
+async def get_image(blob_path, container_name="books"):
+
+    if container_name == "books":
+        image = await template_cache.get(container_name, blob_path)
+    else:
+        image = await download(container_name, blob_path)
     image = io.BytesIO(image)
 
     image.name = (
@@ -416,54 +547,186 @@ async def get_image(blob_path, blob_client, container_name="books"):
     return image
 
 
-async def intermediate(msg, worker_name):
+def message_key(json_data):
 
-    global preview_ids
-    json_data = json.loads(str(msg.message))
-    preview_id = json_data["data"]
+    return job_key(
+        json_data["data"],
+        json_data.get("mode", PREVIEW),
+        json_data.get("attempt", 0),
+    )
+
+
+def retryable(error):
+
+    # Bad inputs and blocked prompts fail the same way every time
+    if isinstance(error, (UnidentifiedImageError, KeyError, ValueError)):
+        return False
+    if "moderation_blocked" in str(error):
+        return False
+
+    return getattr(error, "status_code", None) not in NON_RETRYABLE_STATUS
+
+
+async def run_job(msg, json_data, worker_name, receiver, redispatch):
+
+    key = message_key(json_data)
+
+    try:
+        await process_message(json_data, worker_name)
+    except Exception as e:
+        log_function(e)
+        dedup.fail(key)
+        await settle_failure(msg, json_data, e, receiver, redispatch)
+        raise
+    else:
+        dedup.complete(key)
+        await settle(receiver.complete_message, msg)
+
+
+async def settle_failure(msg, json_data, error, receiver, redispatch):
+
+    attempt = json_data.get("attempt", 0)
+    reason = None
+    if not retryable(error):
+        reason = "not retryable"
+    elif attempt >= JOB_RETRIES:
+        reason = "retries exhausted"
+
+    if reason is not None:
+        await settle(partial(
+            receiver.dead_letter_message,
+            reason=reason,
+            error_description=str(error)[:1024],
+        ), msg)
+        return
+
+    # The deployments in this message were reserved for one attempt only;
+    # a redelivery would bypass the rate limiter
+    try:
+        await redispatch.send_messages(ServiceBusMessage(json.dumps({
+            "data": json_data["data"],
+            "mode": json_data.get("mode", PREVIEW),
+            "quality": json_data.get("quality"),
+            "attempt": attempt + 1,
+            "pages": json_data.get("pages"),
+        })))
+    except Exception as e:
+        log_function(e)
+        await settle(receiver.abandon_message, msg)
+    else:
+        await settle(receiver.complete_message, msg)
 
-    if preview_id not in preview_ids:
-        preview_ids.append(preview_id)
-        asyncio.create_task(process_message(json_data, worker_name))
 
+async def settle(action, msg):
+
+    try:
+        await action(msg)
+    except Exception as e:
+        log_function(e)
 
-async def worker(worker_name: str):
+
+def lock_duration(json_data):
+
+    # The message settles only when the job is done, so its lock has to
+    # outlast every round of pages the reserved slots run in turn
+    pages = json_data.get("pages") or 2
+    slots = len(json_data.get("deployments") or ()) or 2
+
+    return LOCK_RENEW_SECS + math.ceil(pages / slots) * PAGE_LOCK_SECS
+
+
+async def intermediate(msg, worker_name, receiver, redispatch, renewer,
+                       pool):
+
+    try:
+        json_data = json.loads(str(msg.message))
+        claimed = dedup.claim(message_key(json_data))
+    except Exception:
+        pool.release()
+        raise
+
+    if claimed:
+        renewer.register(
+            receiver, msg, max_lock_renewal_duration=lock_duration(json_data)
+        )
+        pool.spawn(run_job(msg, json_data, worker_name, receiver, redispatch))
+    else:
+        pool.release()
+        await receiver.complete_message(msg)
+
+
+async def worker(worker_name: str, pool: WorkerPool):
 
     try:
 
         client = ServiceBusClient.from_connection_string(CONNECTION_STR)
         async with client:
+            # No prefetch: messages are only locked once a job slot is free
             receiver = client.get_queue_receiver(
                 queue_name=QUEUE_NAME,
                 receive_mode=ServiceBusReceiveMode.PEEK_LOCK,
-                prefetch_count=20
+                prefetch_count=0
             )
-            async with receiver, AutoLockRenewer() as renewer:
+            redispatch = client.get_queue_sender(queue_name=REDISPATCH_QUEUE)
+            async with receiver, redispatch, AutoLockRenewer() as renewer:
                 while True:
+                    slots = await pool.reserve(RECEIVE_BATCH)
                     msgs = await receiver.receive_messages(
-                        max_message_count=1, max_wait_time=5
-                    )
-                    if not msgs:
-                        continue
-                    msg = msgs[0]
-                    renewer.register(
-                        receiver, msg, max_lock_renewal_duration=LOCK_RENEW_SECS
+                        max_message_count=slots, max_wait_time=5
                     )
+                    if len(msgs) < slots:
+                        pool.release(slots - len(msgs))
+
+                    for msg in msgs:
 
-                    try:
+                        try:
 
-                        await intermediate(msg, worker_name)
-                        await receiver.complete_message(msg)
+                            await intermediate(
+                                msg, worker_name, receiver, redispatch,
+                                renewer, pool
+                            )
 
-                    except Exception as exc:
+                        except Exception as exc:
 
-                        log_function(exc)
-                        await receiver.abandon_message(msg)
+                            log_function(exc)
+                            await receiver.abandon_message(msg)
 
     except Exception as e:
         log_function(e)
 
 
+def open_stores():
+
+    global dedup, template_cache, description_cache
+
+    dedup = DedupIndex("webjob")
+    template_cache = TemplateCache()
+    description_cache = DescriptionCache()
+
+
+async def main():
+
+    open_stores()
+    pool = WorkerPool(CONCURRENCY)
+    reporter = asyncio.create_task(pool.report(POOL_REPORT_SECS))
+    evictor = asyncio.create_task(openai_clients.run_eviction())
+
+    try:
+        await asyncio.gather(
+            *(worker(f"w{i + 1}", pool) for i in range(RECEIVERS))
+        )
+    finally:
+        reporter.cancel()
+        evictor.cancel()
+        await pool.drain()
+        await uploads.drain()
+        await openai_clients.close()
+        await close_telemetry()
+        await close_client()
+        await close_blob_service()
+        shutdown_executor()
+
+
 if __name__ == "__main__":
 
-    asyncio.run(worker("w1"))
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import asyncio
+import os
+from azure.servicebus import ServiceBusMessage
+from azure.servicebus.exceptions import MessageSizeExceededError
+
+
+FORWARD_LINGER_SECS = float(os.getenv("FORWARD_LINGER_SECS", "0.05"))
+FORWARD_BATCH = int(os.getenv("FORWARD_BATCH", "50"))
+
+
+class BatchSender:
+
+    def __init__(self, sender, linger=FORWARD_LINGER_SECS,
+                 max_batch=FORWARD_BATCH):
+
+        self.sender = sender
+        self.linger = linger
+        self.max_batch = max_batch
+        self._pending = asyncio.Queue()
+        self._task = None
+
+    async def __aenter__(self):
+
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+
+        await self._pending.join()
+        self._task.cancel()
+
+    async def send(self, body):
+
+        future = asyncio.get_running_loop().create_future()
+        await self._pending.put((body, future))
+        await future
+
+    async def _run(self):
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            items = [await self._pending.get()]
+
+            # Give concurrent dispatches a moment to join this batch
+            deadline = loop.time() + self.linger
+            while len(items) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(
+                        await asyncio.wait_for(self._pending.get(), remaining)
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._send(items)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in items:
+                    self._pending.task_done()
+
+    async def _send(self, items):
+
+        batch = await self.sender.create_message_batch()
+        in_batch = []
+
+        for body, future in items:
+            try:
+                batch.add_message(ServiceBusMessage(body))
+            except MessageSizeExceededError:
+                await self._send_batch(batch, in_batch)
+                batch = await self.sender.create_message_batch()
+                in_batch = []
+                batch.add_message(ServiceBusMessage(body))
+            in_batch.append(future)
+
+        await self._send_batch(batch, in_batch)
+
+    async def _send_batch(self, batch, futures):
+
+        if not futures:
+            return
+
+        try:
+            await self.sender.send_messages(batch)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
@@ -0,0 +1,92 @@
+import os
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
+from azure.storage.blob.aio import BlobServiceClient
+
+
+# Blobs above the single-get size are fetched as parallel range requests
+BLOB_SINGLE_GET_SIZE = int(os.getenv("BLOB_SINGLE_GET_SIZE", str(1024 * 1024)))
+BLOB_CHUNK_GET_SIZE = int(os.getenv("BLOB_CHUNK_GET_SIZE", str(1024 * 1024)))
+BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", "4"))
+# Uploads above the single-put size are staged as parallel blocks
+BLOB_SINGLE_PUT_SIZE = int(
+    os.getenv("BLOB_SINGLE_PUT_SIZE", str(4 * 1024 * 1024))
+)
+BLOB_BLOCK_SIZE = int(os.getenv("BLOB_BLOCK_SIZE", str(4 * 1024 * 1024)))
+
+_service = None
+
+
+class BlobRef:
+
+    # Lightweight stand-in for content that now lives in blob storage
+
+    __slots__ = ("container", "name", "size", "uploaded")
+
+    def __init__(self, container, name, size, uploaded=None):
+
+        self.container = container
+        self.name = name
+        self.size = size
+        # Future resolved once the bytes are durably stored
+        self.uploaded = uploaded
+
+    def __repr__(self):
+
+        return f"BlobRef({self.container}/{self.name}, {self.size} bytes)"
+
+
+def get_blob_service():
+
+    global _service
+
+    if _service is None:
+        _service = BlobServiceClient.from_connection_string(
+            os.environ["connection_string"],
+            max_single_get_size=BLOB_SINGLE_GET_SIZE,
+            max_chunk_get_size=BLOB_CHUNK_GET_SIZE,
+            max_single_put_size=BLOB_SINGLE_PUT_SIZE,
+            max_block_size=BLOB_BLOCK_SIZE,
+        )
+
+    return _service
+
+
+async def close_blob_service():
+
+    global _service
+
+    if _service is not None:
+        await _service.close()
+        _service = None
+
+
+async def download(container_name, blob_path):
+
+    blob_client = get_blob_service().get_blob_client(container_name, blob_path)
+    stream = await blob_client.download_blob(
+        max_concurrency=BLOB_DOWNLOAD_CONCURRENCY
+    )
+
+    return await stream.readall()
+
+
+async def download_if_modified(container_name, blob_path, etag=None):
+
+    # Returns (None, None) when the stored copy with `etag` is still current
+    blob_client = get_blob_service().get_blob_client(container_name, blob_path)
+    conditions = {}
+    if etag:
+        conditions = {
+            "etag": etag,
+            "match_condition": MatchConditions.IfModified,
+        }
+
+    try:
+        stream = await blob_client.download_blob(
+            max_concurrency=BLOB_DOWNLOAD_CONCURRENCY, **conditions
+        )
+    except ResourceNotModifiedError:
+        return None, None
+
+    return await stream.readall(), stream.properties
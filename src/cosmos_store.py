@@ -0,0 +1,302 @@
+import asyncio
+import copy
+import os
+import uuid
+from collections import OrderedDict
+from azure.core import MatchConditions
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceNotFoundError,
+)
+
+
+DATABASE_NAME = "storybook_db"
+COSMOS_BACKEND = os.getenv("COSMOS_BACKEND", "azure")
+# Partition key path of previews_container, read from the container when
+# unset; anything other than /id needs one lookup query per preview before
+# point operations can be used
+PREVIEWS_PARTITION_KEY = os.getenv("PREVIEWS_PARTITION_KEY")
+PARTITION_KEY_CACHE_SIZE = int(os.getenv("PARTITION_KEY_CACHE_SIZE", "10000"))
+PATCH_RETRIES = int(os.getenv("COSMOS_PATCH_RETRIES", "5"))
+PATCH_BACKOFF_SECS = float(os.getenv("COSMOS_PATCH_BACKOFF_SECS", "0.2"))
+# Cosmos accepts at most 10 operations per patch request
+MAX_PATCH_OPERATIONS = 10
+RETRYABLE_STATUS = (412, 429, 449, 503)
+
+_client = None
+_containers = {}
+_partition_paths = {}
+# preview id -> partition key value, least recently used first
+_partition_keys = OrderedDict()
+
+
+def get_client():
+
+    global _client
+
+    if _client is None:
+        _client = CosmosClient(
+            os.environ["cosmos_db_url"],
+            credential=os.environ["cosmos_db_key"],
+        )
+
+    return _client
+
+
+def get_container(name):
+
+    container = _containers.get(name)
+    if container is None:
+        if COSMOS_BACKEND == "memory":
+            container = InMemoryContainer(name)
+        else:
+            container = (
+                get_client()
+                .get_database_client(DATABASE_NAME)
+                .get_container_client(name)
+            )
+        _containers[name] = container
+
+    return container
+
+
+async def close_client():
+
+    global _client
+
+    _containers.clear()
+    _partition_paths.clear()
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+async def partition_key_path(container):
+
+    # Read once per container from its properties; the env override only
+    # skips that lookup
+    path = _partition_paths.get(container.id)
+    if path is None:
+        path = PREVIEWS_PARTITION_KEY
+        if not path:
+            properties = await container.read()
+            path = properties["partitionKey"]["paths"][0]
+        _partition_paths[container.id] = path
+
+    return path
+
+
+def partition_key_of(item, path):
+
+    value = item
+    for part in path.strip("/").split("/"):
+        value = value[part]
+
+    return value
+
+
+def _remember_partition_key(preview_id, partition_key):
+
+    _partition_keys[preview_id] = partition_key
+    _partition_keys.move_to_end(preview_id)
+    while len(_partition_keys) > PARTITION_KEY_CACHE_SIZE:
+        _partition_keys.popitem(last=False)
+
+
+async def read_preview(container, preview_id):
+
+    path = await partition_key_path(container)
+    if path == "/id":
+        return await container.read_item(preview_id, partition_key=preview_id)
+
+    partition_key = _partition_keys.get(preview_id)
+    if partition_key is not None:
+        _partition_keys.move_to_end(preview_id)
+        return await container.read_item(
+            preview_id, partition_key=partition_key
+        )
+
+    items = [
+        item
+        async for item in container.query_items(
+            query="SELECT * FROM c WHERE c.id = @id",
+            parameters=[{"name": "@id", "value": preview_id}],
+        )
+    ]
+    if not items:
+        raise CosmosResourceNotFoundError(
+            status_code=404, message=f"preview {preview_id} not found"
+        )
+
+    _remember_partition_key(preview_id, partition_key_of(items[0], path))
+    return items[0]
+
+
+async def preview_partition_key(container, preview_id):
+
+    if await partition_key_path(container) == "/id":
+        return preview_id
+
+    if preview_id not in _partition_keys:
+        await read_preview(container, preview_id)
+
+    return _partition_keys[preview_id]
+
+
+async def read_book(container, book_id):
+
+    return await container.read_item(book_id, partition_key=book_id)
+
+
+class PreviewSession:
+
+    def __init__(self, container, preview_id, data=None):
+
+        self.container = container
+        self.preview_id = preview_id
+        self.data = data
+        self._changes = {}
+
+    @classmethod
+    async def open(cls, container, preview_id):
+
+        return cls(
+            container, preview_id, await read_preview(container, preview_id)
+        )
+
+    def set(self, **fields):
+
+        for field, value in fields.items():
+            if (
+                self.data is not None
+                and field not in self._changes
+                and self.data.get(field) == value
+            ):
+                continue
+            self._changes[field] = value
+            if self.data is not None:
+                self.data[field] = value
+
+    async def flush(self):
+
+        if not self._changes:
+            return
+
+        operations = [
+            {"op": "set", "path": f"/{field}", "value": value}
+            for field, value in self._changes.items()
+        ]
+        partition_key = await preview_partition_key(
+            self.container, self.preview_id
+        )
+
+        for i in range(0, len(operations), MAX_PATCH_OPERATIONS):
+            await self._patch(
+                partition_key, operations[i:i + MAX_PATCH_OPERATIONS]
+            )
+
+        self._changes.clear()
+
+    async def _patch(self, partition_key, operations):
+
+        # Patches only touch their own fields, so a concurrent writer (e.g.
+        # handle_rate stamping request_time) cannot make them stale; only
+        # transient throttling/contention is retried
+        for attempt in range(PATCH_RETRIES):
+            try:
+                return await self.container.patch_item(
+                    item=self.preview_id,
+                    partition_key=partition_key,
+                    patch_operations=operations,
+                )
+            except CosmosHttpResponseError as e:
+                if (
+                    e.status_code not in RETRYABLE_STATUS
+                    or attempt == PATCH_RETRIES - 1
+                ):
+                    raise
+                await asyncio.sleep(PATCH_BACKOFF_SECS * 2 ** attempt)
+
+
+class InMemoryContainer:
+
+    # Local stand-in for an azure.cosmos.aio ContainerProxy, enough for the
+    # preview/book bookkeeping in this package
+
+    def __init__(self, name, items=(), partition_key_path="/id"):
+
+        self.name = name
+        self.id = name
+        self.partition_key_path = partition_key_path
+        self.items = {}
+        for item in items:
+            self._store(copy.deepcopy(item))
+
+    def _store(self, item):
+
+        item["_etag"] = uuid.uuid4().hex
+        self.items[item["id"]] = item
+        return copy.deepcopy(item)
+
+    def _get(self, item_id):
+
+        if item_id not in self.items:
+            raise CosmosResourceNotFoundError(
+                status_code=404, message=f"{item_id} not found"
+            )
+
+        return self.items[item_id]
+
+    async def read(self):
+
+        return {
+            "id": self.id,
+            "partitionKey": {"paths": [self.partition_key_path]},
+        }
+
+    async def read_item(self, item, partition_key=None):
+
+        return copy.deepcopy(self._get(item))
+
+    async def query_items(self, query, parameters=None, **kwargs):
+
+        # Only the point lookup used by read_preview is supported
+        values = {p["name"]: p["value"] for p in parameters or ()}
+        item = self.items.get(values.get("@id"))
+        if item is not None:
+            yield copy.deepcopy(item)
+
+    async def create_item(self, body, **kwargs):
+
+        return self._store(copy.deepcopy(body))
+
+    async def upsert_item(self, body, **kwargs):
+
+        return self._store(copy.deepcopy(body))
+
+    async def replace_item(self, item, body, etag=None,
+                           match_condition=None, **kwargs):
+
+        current = self._get(item)
+        if (
+            match_condition == MatchConditions.IfNotModified
+            and etag != current["_etag"]
+        ):
+            raise CosmosAccessConditionFailedError(
+                status_code=412, message="etag mismatch"
+            )
+
+        return self._store(copy.deepcopy(body))
+
+    async def patch_item(self, item, partition_key, patch_operations,
+                         **kwargs):
+
+        body = copy.deepcopy(self._get(item))
+        for operation in patch_operations:
+            if operation["op"] not in ("set", "add", "replace"):
+                raise ValueError(f"unsupported patch op {operation['op']}")
+            body[operation["path"].lstrip("/")] = operation["value"]
+
+        return self._store(body)
@@ -0,0 +1,155 @@
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", "10000"))
+DEDUP_IN_FLIGHT_TTL = float(os.getenv("DEDUP_IN_FLIGHT_TTL", "3600"))
+DEDUP_COMPLETED_TTL = float(os.getenv("DEDUP_COMPLETED_TTL", "3600"))
+# Failed ids may be retried as soon as the message is redelivered
+DEDUP_FAILED_TTL = float(os.getenv("DEDUP_FAILED_TTL", "0"))
+DEDUP_PATH = os.getenv("DEDUP_PATH")
+
+IN_FLIGHT = "in_flight"
+COMPLETED = "completed"
+FAILED = "failed"
+
+PREVIEW = "preview"
+FULL_BOOK = "full"
+
+
+def job_key(preview_id, mode=PREVIEW, attempt=0):
+
+    # A full-book render of an already previewed book is a separate job
+    key = preview_id
+    if mode == FULL_BOOK:
+        key = f"{preview_id}:{FULL_BOOK}"
+
+    # and so is each re-dispatch of a failed one
+    if attempt:
+        key = f"{key}:retry{attempt}"
+
+    return key
+
+
+class DedupIndex:
+
+    def __init__(self, namespace, max_size=DEDUP_MAX_SIZE, path=DEDUP_PATH,
+                 ttls=None):
+
+        # Services sharing one DEDUP_PATH keep separate entries
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttls = ttls or {
+            IN_FLIGHT: DEDUP_IN_FLIGHT_TTL,
+            COMPLETED: DEDUP_COMPLETED_TTL,
+            FAILED: DEDUP_FAILED_TTL,
+        }
+        # id -> (state, expires), oldest update first
+        self._entries = OrderedDict()
+        self._conn = None
+
+        if path:
+            self._conn = sqlite3.connect(path, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS dedup_entries "
+                "(namespace TEXT NOT NULL, id TEXT NOT NULL, "
+                "state TEXT NOT NULL, expires REAL NOT NULL, "
+                "PRIMARY KEY (namespace, id))"
+            )
+            self._conn.execute(
+                "DELETE FROM dedup_entries WHERE namespace = ? "
+                "AND expires <= ?",
+                (namespace, time.time()),
+            )
+            for key, state, expires in self._conn.execute(
+                "SELECT id, state, expires FROM dedup_entries "
+                "WHERE namespace = ? ORDER BY expires",
+                (namespace,),
+            ):
+                self._entries[key] = (state, expires)
+            self._evict(time.time())
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def __contains__(self, key):
+
+        return self.state(key) is not None
+
+    def state(self, key):
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        state, expires = entry
+        if expires <= time.time():
+            self._forget(key)
+            return None
+
+        return state
+
+    def claim(self, key):
+
+        if self.state(key) in (IN_FLIGHT, COMPLETED):
+            return False
+
+        self._set(key, IN_FLIGHT)
+        return True
+
+    def complete(self, key):
+
+        self._set(key, COMPLETED)
+
+    def fail(self, key):
+
+        self._set(key, FAILED)
+
+    def release(self, key):
+
+        self._forget(key)
+
+    def _set(self, key, state):
+
+        now = time.time()
+        expires = now + self.ttls[state]
+        self._entries[key] = (state, expires)
+        self._entries.move_to_end(key)
+
+        # Only completions outlive the process: an in-flight entry left by
+        # a crash must not block the redelivered message after a restart
+        if self._conn is not None:
+            if state == COMPLETED:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO dedup_entries "
+                    "(namespace, id, state, expires) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, state, expires),
+                )
+            else:
+                self._delete(key)
+
+        self._evict(now)
+
+    def _forget(self, key):
+
+        if self._entries.pop(key, None) is not None and self._conn is not None:
+            self._delete(key)
+
+    def _delete(self, key):
+
+        self._conn.execute(
+            "DELETE FROM dedup_entries WHERE namespace = ? AND id = ?",
+            (self.namespace, key),
+        )
+
+    def _evict(self, now):
+
+        while self._entries:
+            key, (_, expires) = next(iter(self._entries.items()))
+            if expires > now and len(self._entries) <= self.max_size:
+                break
+            self._forget(key)
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import signal
+from logging_utility import log_function
+from rate_state import RATE_LIMIT
+
+
+DEPLOYMENTS_FILE = os.getenv("DEPLOYMENTS_FILE")
+DEPLOYMENTS_WATCH_SECS = float(os.getenv("DEPLOYMENTS_WATCH_SECS", "30"))
+
+# Used when no DEPLOYMENTS_FILE is configured: zone -> (index of the
+# api_key_N/endpoint_N pair, indices of the deployment_N variables)
+ENV_ZONES = {
+    "westus": (1, [1, 2, 3, 13, 14, 15]),
+    "middle-east": (2, [4, 5, 6, 16, 17, 18]),
+    "poland": (3, [7, 8, 22, 23, 24]),
+    "eastus": (4, [10, 11, 12]),
+    "sweden": (5, [19, 20, 21]),
+}
+
+
+class Deployment:
+
+    __slots__ = ("zone", "name", "api_key", "endpoint", "limit", "payload")
+
+    def __init__(self, zone, name, api_key, endpoint, limit=RATE_LIMIT):
+
+        self.zone = zone
+        self.name = name
+        self.api_key = api_key
+        self.endpoint = endpoint
+        self.limit = limit
+        # Forwarded as-is to the generation workers
+        self.payload = {
+            "deployment-name": name,
+            "api_key": api_key,
+            "endpoint": endpoint,
+        }
+
+    def __repr__(self):
+
+        return f"Deployment({self.zone!r}, {self.name!r}, limit={self.limit})"
+
+
+def _resolve(value):
+
+    # "$name" reads the secret from the environment instead of the file
+    if isinstance(value, str) and value.startswith("$"):
+        return os.environ[value[1:]]
+
+    return value
+
+
+def load_from_file(path):
+
+    with open(path) as f:
+        config = json.load(f)
+
+    return [
+        Deployment(
+            zone,
+            _resolve(entry["deployment-name"]),
+            _resolve(entry["api_key"]),
+            _resolve(entry["endpoint"]),
+            int(entry.get("limit", RATE_LIMIT)),
+        )
+        for zone, entries in config["zones"].items()
+        for entry in entries
+    ]
+
+
+def load_from_env():
+
+    return [
+        Deployment(
+            zone,
+            os.environ[f"deployment_{index}"],
+            os.environ[f"api_key_{credential}"],
+            os.environ[f"endpoint_{credential}"],
+        )
+        for zone, (credential, indices) in ENV_ZONES.items()
+        for index in indices
+    ]
+
+
+class DeploymentRegistry:
+
+    def __init__(self, path=DEPLOYMENTS_FILE, log=log_function):
+
+        self.path = path
+        # Reload messages go to the owning service's log
+        self.log = log
+        self.deployments = ()
+        self._mtime = None
+        self._listeners = []
+
+    def __iter__(self):
+
+        return iter(self.deployments)
+
+    def __len__(self):
+
+        return len(self.deployments)
+
+    def subscribe(self, listener):
+
+        self._listeners.append(listener)
+
+    def load(self):
+
+        if self.path:
+            self._mtime = os.stat(self.path).st_mtime
+            deployments = load_from_file(self.path)
+        else:
+            deployments = load_from_env()
+
+        names = [deployment.name for deployment in deployments]
+        if len(set(names)) != len(names):
+            raise ValueError("duplicate deployment names in registry")
+
+        self.deployments = tuple(deployments)
+        for listener in self._listeners:
+            listener(self)
+
+        return self
+
+    def reload(self):
+
+        try:
+            self.load()
+            self.log(f"Reloaded {len(self)} deployments")
+        except Exception as e:
+            # Keep serving with the last good registry
+            self.log(e)
+
+    def changed(self):
+
+        if not self.path:
+            return False
+
+        try:
+            return os.stat(self.path).st_mtime != self._mtime
+        except OSError:
+            return False
+
+    async def watch(self, interval=DEPLOYMENTS_WATCH_SECS):
+
+        while True:
+            await asyncio.sleep(interval)
+            if self.changed():
+                self.reload()
+
+    def install_signal_handler(self):
+
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGHUP, self.reload
+            )
+        except (NotImplementedError, AttributeError):
+            # No SIGHUP on this platform, the file watcher still works
+            pass
@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from cosmos_store import get_container
+from logging_utility import log_function
+
+
+DESCRIPTION_CACHE_BACKEND = os.getenv("DESCRIPTION_CACHE_BACKEND", "memory")
+DESCRIPTION_CACHE_TTL = float(
+    os.getenv("DESCRIPTION_CACHE_TTL", str(30 * 24 * 3600))
+)
+DESCRIPTION_CACHE_SIZE = int(os.getenv("DESCRIPTION_CACHE_SIZE", "10000"))
+DESCRIPTION_CACHE_PATH = os.getenv(
+    "DESCRIPTION_CACHE_PATH", "descriptions.sqlite3"
+)
+DESCRIPTION_CACHE_CONTAINER = os.getenv(
+    "DESCRIPTION_CACHE_CONTAINER", "description_cache"
+)
+
+
+def cache_key(image_bytes, prompt):
+
+    # A prompt edit changes the key, so stale descriptions are never served
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+    return f"{image_hash}-{prompt_hash}"
+
+
+class MemoryDescriptionStore:
+
+    def __init__(self, max_size=DESCRIPTION_CACHE_SIZE):
+
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    async def get(self, key):
+
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        self._items.move_to_end(key)
+        return item
+
+    async def set(self, key, description, expires):
+
+        self._items[key] = (description, expires)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+
+class SQLiteDescriptionStore:
+
+    def __init__(self, path=DESCRIPTION_CACHE_PATH):
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS descriptions "
+            "(key TEXT PRIMARY KEY, description TEXT NOT NULL, "
+            "expires REAL NOT NULL)"
+        )
+
+    def _get(self, key):
+
+        with self._lock:
+            return self._conn.execute(
+                "SELECT description, expires FROM descriptions WHERE key = ?",
+                (key,),
+            ).fetchone()
+
+    def _set(self, key, description, expires):
+
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM descriptions WHERE expires <= ?", (time.time(),)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO descriptions "
+                "(key, description, expires) VALUES (?, ?, ?)",
+                (key, description, expires),
+            )
+
+    async def get(self, key):
+
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key, description, expires):
+
+        await asyncio.to_thread(self._set, key, description, expires)
+
+
+class CosmosDescriptionStore:
+
+    # Expects a container partitioned on /id; "ttl" lets Cosmos expire
+    # items itself when the container has TTL enabled
+
+    def __init__(self, container_name=DESCRIPTION_CACHE_CONTAINER):
+
+        self.container_name = container_name
+
+    async def get(self, key):
+
+        try:
+            item = await get_container(self.container_name).read_item(
+                key, partition_key=key
+            )
+        except CosmosResourceNotFoundError:
+            return None
+
+        return item["description"], item["expires"]
+
+    async def set(self, key, description, expires):
+
+        await get_container(self.container_name).upsert_item({
+            "id": key,
+            "description": description,
+            "expires": expires,
+            "ttl": max(int(expires - time.time()), 1),
+        })
+
+
+STORES = {
+    "memory": MemoryDescriptionStore,
+    "sqlite": SQLiteDescriptionStore,
+    "cosmos": CosmosDescriptionStore,
+}
+
+
+class DescriptionCache:
+
+    def __init__(self, store=None, ttl=DESCRIPTION_CACHE_TTL):
+
+        self.store = store or STORES[DESCRIPTION_CACHE_BACKEND]()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, image_bytes, prompt):
+
+        # Best effort: a store error is a miss, never a failed preview
+        try:
+            item = await self.store.get(cache_key(image_bytes, prompt))
+        except Exception as e:
+            log_function(f"Description cache read failed: {e}")
+            item = None
+
+        if item is None or item[1] <= time.time():
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return item[0]
+
+    async def set(self, image_bytes, prompt, description):
+
+        try:
+            await self.store.set(
+                cache_key(image_bytes, prompt),
+                description,
+                time.time() + self.ttl,
+            )
+        except Exception as e:
+            log_function(f"Description cache write failed: {e}")
@@ -1,393 +1,337 @@
 import asyncio
 import json
 import os
+import uuid
 from azure.servicebus.aio import ServiceBusClient, AutoLockRenewer
-from azure.servicebus import ServiceBusReceiveMode, ServiceBusMessage
-from azure.cosmos import CosmosClient
+from azure.servicebus import ServiceBusReceiveMode
 from datetime import datetime
-from typing import Dict
-from azure.storage.blob import BlobServiceClient, ContentSettings
-from azure.core.exceptions import ResourceNotFoundError
-from azure.core import MatchConditions
+from logging_utility import get_sink
+from batch_sender import BatchSender
+from dedup import FULL_BOOK, PREVIEW, DedupIndex, job_key
+from cosmos_store import (
+    PreviewSession,
+    get_container,
+    read_book,
+    read_preview,
+)
+from deployment_registry import DeploymentRegistry
+from rate_limiter import AimdController, RateLimiter, RateLimitTimeout
+from rate_state import get_rate_state
+from selection import DeploymentStats, get_policy
 
 
 CONNECTION_STR = os.environ["SERVICE_BUS"]
 QUEUE_NAME = "queue"  # fallback default
 LOCK_RENEW_SECS = int(os.getenv("LOCK_RENEW_SECS", "300"))
-COSMOS_URL = os.getenv("cosmos_db_url")
-COSMOS_KEY = os.getenv("cosmos_db_key")
-DATABASE_NAME = "storybook_db"
-preview_ids = []
-
-cosmos_client = CosmosClient(COSMOS_URL, credential=COSMOS_KEY)
-database = cosmos_client.get_database_client(DATABASE_NAME)
-previews_container = database.get_container_client("previews_container")
-rate_limits = {
-    "westus": {
-        "gpt-image-1-1": [],
-        "gpt-image-1-2": [],
-        "gpt-image-1-3": [],
-        "gpt-image-1-13": [],
-        "gpt-image-1-14": [],
-        "gpt-image-1-15": [],
-    },
-    "middle-east": {
-        "gpt-image-1-4": [],
-        "gpt-image-1-5": [],
-        "gpt-image-1-6": [],
-        "gpt-image-1-16": [],
-        "gpt-image-1-17": [],
-        "gpt-image-1-18": [],
-    },
-    "poland": {
-        "gpt-image-1-7": [],
-        "gpt-image-1-8": [],
-        "gpt-image-1-22": [],
-        "gpt-image-1-23": [],
-        "gpt-image-1-24": [],
-    },
-    "eastus": {
-        "gpt-image-1-10": [],
-        "gpt-image-1-11": [],
-        "gpt-image-1-12": [],
-    },
-    "sweden": {
-        "gpt-image-1-19": [],
-        "gpt-image-1-20": [],
-        "gpt-image-1-21": [],
-    },
-}
+FEEDBACK_QUEUE = os.getenv("FEEDBACK_QUEUE", "rate_feedback")
+FEEDBACK_RETRY_SECS = float(os.getenv("FEEDBACK_RETRY_SECS", "5"))
+DISPATCH_RETRY_SECS = float(os.getenv("DISPATCH_RETRY_SECS", "5"))
+DISPATCH_BATCH = int(os.getenv("DISPATCH_BATCH", "20"))
+DISPATCH_CONCURRENCY = int(os.getenv("DISPATCH_CONCURRENCY", "20"))
+MAX_DISPATCH_WAIT_SECS = float(
+    os.getenv("MAX_DISPATCH_WAIT_SECS", str(LOCK_RENEW_SECS))
+)
+# Upper bound on deployments reserved for one full-book job, 0 for no cap
+FULL_BOOK_MAX_RESERVE = int(os.getenv("FULL_BOOK_MAX_RESERVE", "0"))
+# Share of the live capacity one full book may wait for at the head of the
+# queue; previews queue behind it until that many slots are free at once
+FULL_BOOK_MAX_SHARE = float(os.getenv("FULL_BOOK_MAX_SHARE", "0.5"))
+dedup = DedupIndex("handle_rate")
+limiter = None
+controller = None
+stats = DeploymentStats()
 
 
 def log_function(log_content, clear_file=0):
 
-    log_content = "[HANDLE PREVIEW] " + str(log_content) + "\n"
-    connection_string = os.getenv("connection_string")
-    log_container_name = "logs"
-    log_blob_name = "log_web_jobs.txt"
+    get_sink(
+        "log_web_jobs.txt", prefix="[HANDLE PREVIEW] ", timezone=None
+    ).write(log_content, clear_file)
 
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string
-    )
-    blob_client = blob_service_client.get_blob_client(
-        log_container_name, log_blob_name
-    )
 
-    if clear_file == 1:
-        blob_client.upload_blob(
-            b"",
-            overwrite=True,
-            content_settings=ContentSettings(content_type="text/plain")
+registry = DeploymentRegistry(log=log_function)
+
+
+def get_limiter():
+
+    global limiter
+
+    if limiter is None:
+        if not len(registry):
+            registry.load()
+        limiter = RateLimiter(
+            registry, get_rate_state(registry_limits()), get_policy(stats)
         )
+        registry.subscribe(on_registry_reload)
 
-    try:
-        existing = blob_client.download_blob().readall()
-    except ResourceNotFoundError:
-        existing = b""
+    return limiter
 
-    current_time_ist = datetime.now().strftime(
-        "Current Time : %Y-%m-%d %H:%M:%S"
-    )
-    timestamp_content = f"{current_time_ist} : "
-    time_stamp_content_bytes = timestamp_content.encode("utf-8")
-    log_content_bytes = log_content.encode("utf-8")
-
-    blob_client.upload_blob(
-        existing + time_stamp_content_bytes + log_content_bytes,
-        overwrite=True,
-        content_settings=ContentSettings(content_type="text/plain")
-    )
 
+def get_controller():
 
-def get_deployments():
+    global controller
 
-    deployments = {
-        "westus": [
-            {
-                "deployment-name": os.environ["deployment_1"],
-                "api_key": os.environ["api_key_1"],
-                "endpoint": os.environ["endpoint_1"],
-            },
-            {
-                "deployment-name": os.environ["deployment_2"],
-                "api_key": os.environ["api_key_1"],
-                "endpoint": os.environ["endpoint_1"],
-            },
-            {
-                "deployment-name": os.environ["deployment_3"],
-                "api_key": os.environ["api_key_1"],
-                "endpoint": os.environ["endpoint_1"],
-            },
-            {
-                "deployment-name": os.environ["deployment_13"],
-                "api_key": os.environ["api_key_1"],
-                "endpoint": os.environ["endpoint_1"],
-            },
-            {
-                "deployment-name": os.environ["deployment_14"],
-                "api_key": os.environ["api_key_1"],
-                "endpoint": os.environ["endpoint_1"],
-            },
-            {
-                "deployment-name": os.environ["deployment_15"],
-                "api_key": os.environ["api_key_1"],
-                "endpoint": os.environ["endpoint_1"],
-            },
-        ],
-        "middle-east": [
-            {
-                "deployment-name": os.environ["deployment_4"],
-                "api_key": os.environ["api_key_2"],
-                "endpoint": os.environ["endpoint_2"],
-            },
-            {
-                "deployment-name": os.environ["deployment_5"],
-                "api_key": os.environ["api_key_2"],
-                "endpoint": os.environ["endpoint_2"],
-            },
-            {
-                "deployment-name": os.environ["deployment_6"],
-                "api_key": os.environ["api_key_2"],
-                "endpoint": os.environ["endpoint_2"],
-            },
-            {
-                "deployment-name": os.environ["deployment_16"],
-                "api_key": os.environ["api_key_2"],
-                "endpoint": os.environ["endpoint_2"],
-            },
-            {
-                "deployment-name": os.environ["deployment_17"],
-                "api_key": os.environ["api_key_2"],
-                "endpoint": os.environ["endpoint_2"],
-            },
-            {
-                "deployment-name": os.environ["deployment_18"],
-                "api_key": os.environ["api_key_2"],
-                "endpoint": os.environ["endpoint_2"],
-            },
-        ],
-        "poland": [
-            {
-                "deployment-name": os.environ["deployment_7"],
-                "api_key": os.environ["api_key_3"],
-                "endpoint": os.environ["endpoint_3"],
-            },
-            {
-                "deployment-name": os.environ["deployment_8"],
-                "api_key": os.environ["api_key_3"],
-                "endpoint": os.environ["endpoint_3"],
-            },
-            {
-                "deployment-name": os.environ["deployment_22"],
-                "api_key": os.environ["api_key_3"],
-                "endpoint": os.environ["endpoint_3"],
-            },
-            {
-                "deployment-name": os.environ["deployment_23"],
-                "api_key": os.environ["api_key_3"],
-                "endpoint": os.environ["endpoint_3"],
-            },
-            {
-                "deployment-name": os.environ["deployment_24"],
-                "api_key": os.environ["api_key_3"],
-                "endpoint": os.environ["endpoint_3"],
-            },
-        ],
-        "eastus": [
-            {
-                "deployment-name": os.environ["deployment_10"],
-                "api_key": os.environ["api_key_4"],
-                "endpoint": os.environ["endpoint_4"],
-            },
-            {
-                "deployment-name": os.environ["deployment_11"],
-                "api_key": os.environ["api_key_4"],
-                "endpoint": os.environ["endpoint_4"],
-            },
-            {
-                "deployment-name": os.environ["deployment_12"],
-                "api_key": os.environ["api_key_4"],
-                "endpoint": os.environ["endpoint_4"],
-            },
-        ],
-        "sweden": [
-            {
-                "deployment-name": os.environ["deployment_19"],
-                "api_key": os.environ["api_key_5"],
-                "endpoint": os.environ["endpoint_5"],
-            },
-            {
-                "deployment-name": os.environ["deployment_20"],
-                "api_key": os.environ["api_key_5"],
-                "endpoint": os.environ["endpoint_5"],
-            },
-            {
-                "deployment-name": os.environ["deployment_21"],
-                "api_key": os.environ["api_key_5"],
-                "endpoint": os.environ["endpoint_5"],
-            },
-        ],
-    }
+    if controller is None:
+        controller = AimdController(get_limiter())
 
-    return deployments
+    return controller
 
 
-def get_available_deployment(deployments: Dict) -> dict:
+def registry_limits():
 
-    global rate_limits
-    current_time = datetime.now()
+    return {deployment.name: deployment.limit for deployment in registry}
 
-    for zone, zone_deployments in deployments.items():
-        for deployment in zone_deployments:
-            deployment_name = deployment["deployment-name"]
 
-            # Get the list of timestamps for the current deployment
-            timestamps = rate_limits.get(zone, {}).get(deployment_name, [])
+def on_registry_reload(registry):
 
-            # Count the number of timestamps within the last 60 seconds
-            recent_count = sum(
-                1 for ts in timestamps
-                if (current_time - datetime.fromisoformat(ts)).total_seconds() < 60
-            )
+    get_limiter().sync(registry)
 
-            if recent_count < 3:
-                return deployment
 
-    return {}
+async def modify_start_time(preview_id, container, mode=PREVIEW):
 
+    now = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    session = PreviewSession(container, preview_id)
+    if mode == FULL_BOOK:
+        # The preview keeps its own request time
+        session.set(book_request_time=now)
+    else:
+        session.set(request_time=now)
+    await session.flush()
 
-async def update_timestamps(deploymenter_1, deploymenter_2):
 
-    global rate_limits
-    current_time = datetime.now()
+async def book_page_count(preview_id):
 
-    for zone in rate_limits.keys():
+    preview = await read_preview(
+        get_container("previews_container"), preview_id
+    )
+    book = await read_book(get_container("books_container"), preview["bookId"])
 
-        for deployment in rate_limits[zone].keys():
+    return len(book["pages"])
 
-            rate_limits[zone][deployment] = [
-                ts
-                for ts in rate_limits[zone][deployment]
-                if (
-                    current_time - datetime.fromisoformat(ts)
-                ).total_seconds() < 60
-            ]
 
-            if deployment == deploymenter_1["deployment-name"]:
-                rate_limits[zone][deployment].append(str(current_time))
+async def job_pages(json_data, mode):
 
-            if deployment == deploymenter_2["deployment-name"]:
-                rate_limits[zone][deployment].append(str(current_time))
+    if mode != FULL_BOOK:
+        return None
 
+    return json_data.get("pages") or await book_page_count(json_data["data"])
 
-async def modify_start_time(preview_id, container):
 
-    query = f"SELECT * FROM c WHERE c.id='{preview_id}'"
+async def reservation_size(pages):
 
-    data = list(
-        container.query_items(
-            query=query,
-            enable_cross_partition_query=True,
-        )
-    )[0]
-    data["request_time"] = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    container.replace_item(
-        item=preview_id,
-        body=data,
-        etag=data["_etag"],
-        match_condition=MatchConditions.IfNotModified,
-    )
+    if pages is None:
+        return 2
 
-    return data
+    # Pages beyond the reservation queue behind the reserved slots in the
+    # webjob, which reports each of them back to be charged
+    capacity = await get_limiter().capacity()
+    size = min(pages, int(capacity * FULL_BOOK_MAX_SHARE))
+    if FULL_BOOK_MAX_RESERVE:
+        size = min(size, FULL_BOOK_MAX_RESERVE)
 
+    return max(size, 1)
 
-async def process_message(preview_id):
 
-    global rate_limits, preview_ids
-    preview_id = json.loads(str(preview_id.message))["data"]
-    quality = json.loads(str(preview_id.message))["quality"]
+async def process_message(msg, forwarder):
 
-    if preview_id in preview_ids:
-        return
+    json_data = json.loads(str(msg.message))
+    preview_id = json_data["data"]
+    quality = json_data["quality"]
+    mode = json_data.get("mode", PREVIEW)
+    # Set by the webjob when it sends a failed job back for a new reservation
+    attempt = json_data.get("attempt", 0)
+    key = job_key(preview_id, mode, attempt)
 
-    preview_ids.append(preview_id)
+    if not dedup.claim(key):
+        return
 
-    if len(preview_ids) > 50:
-        preview_ids = preview_ids[30:]
-    log_function(f"Starting to Process: {preview_id}")
+    log_function(f"Starting to Process: {preview_id} ({mode})")
 
-    while True:
-        deployments = get_deployments()
-        deployment_1 = get_available_deployment(deployments)
-        deployment_2 = get_available_deployment(deployments)
-        await update_timestamps(deployment_1, deployment_2)
+    try:
+        pages = await job_pages(json_data, mode)
+        size = await reservation_size(pages)
+        deployments = await get_limiter().acquire(
+            size, timeout=MAX_DISPATCH_WAIT_SECS
+        )
+    except RateLimitTimeout:
+        log_function(f"No capacity for {preview_id}, abandoning")
+        dedup.fail(key)
+        raise
+    except Exception:
+        dedup.fail(key)
+        raise
 
-        if deployment_1 != {} and deployment_2 != {}:
-            break
+    # Each reserved slot carries its own id back through feedback
+    deployments = [
+        dict(deployment, dispatch_id=uuid.uuid4().hex)
+        for deployment in deployments
+    ]
+    dispatch_ids = [deployment["dispatch_id"] for deployment in deployments]
+    stats.started([
+        (deployment["dispatch_id"], deployment["deployment-name"])
+        for deployment in deployments
+    ])
 
     try:
 
-        client = ServiceBusClient.from_connection_string(CONNECTION_STR)
-        sender = client.get_queue_sender(queue_name=QUEUE_NAME)
-        message = ServiceBusMessage(json.dumps(
+        await forwarder.send(json.dumps(
             {
                 "data": preview_id,
-                "deployment_1": deployment_1,
-                "deployment_2": deployment_2,
-                "quality": quality
+                "mode": mode,
+                "deployment_1": deployments[0],
+                "deployment_2": deployments[1 % len(deployments)],
+                "deployments": deployments,
+                "quality": quality,
+                "attempt": attempt,
+                # Lets the webjob size the message lock to the job
+                "pages": pages,
             }
         ))
 
-        await sender.send_messages(message)
-        await sender.close()
-        await client.close()
-
     except Exception as e:
 
         log_function(e)
         log_function("Nope")
+        stats.abandon(dispatch_ids)
+        dedup.fail(key)
         raise
 
-    await modify_start_time(preview_id, previews_container)
+    dedup.complete(key)
+    await modify_start_time(
+        preview_id, get_container("previews_container"), mode
+    )
 
 
-async def worker():
+async def dispatch(msg, receiver, renewer, forwarder):
 
+    renewer.register(
+        receiver,
+        msg,
+        max_lock_renewal_duration=LOCK_RENEW_SECS
+    )
     try:
+        await process_message(msg, forwarder)
+    except Exception as exc:
+        log_function(exc)
+        await receiver.abandon_message(msg)
+    else:
+        await receiver.complete_message(msg)
+
+
+async def worker():
+
+    # Reconnects like feedback_worker: a dead dispatcher must not leave the
+    # process running with nothing being dispatched
+    while True:
+
+        try:
+
+            client = ServiceBusClient.from_connection_string(CONNECTION_STR)
+            async with client:
+                receiver = client.get_queue_receiver(
+                    queue_name="handle_rate",
+                    receive_mode=ServiceBusReceiveMode.PEEK_LOCK,
+                    prefetch_count=20
+                )
+                sender = client.get_queue_sender(queue_name=QUEUE_NAME)
+                async with receiver, sender, AutoLockRenewer() as renewer:
+                    async with BatchSender(sender) as forwarder:
+                        await dispatch_loop(receiver, renewer, forwarder)
+
+        except Exception as e:
+
+            log_function(e)
+            await asyncio.sleep(DISPATCH_RETRY_SECS)
+
 
-        client = ServiceBusClient.from_connection_string(CONNECTION_STR)
-        async with client:
-            receiver = client.get_queue_receiver(
-                queue_name="handle_rate",
-                receive_mode=ServiceBusReceiveMode.PEEK_LOCK,
-                prefetch_count=20
+async def dispatch_loop(receiver, renewer, forwarder):
+
+    slots = asyncio.Semaphore(DISPATCH_CONCURRENCY)
+    tasks = set()
+
+    try:
+        while True:
+            # Only pull as many messages as can be dispatched
+            await slots.acquire()
+            free = DISPATCH_CONCURRENCY - len(tasks)
+            msgs = await receiver.receive_messages(
+                max_message_count=min(DISPATCH_BATCH, free),
+                max_wait_time=5
             )
-            async with receiver, AutoLockRenewer() as renewer:
-                while True:
-                    msgs = await receiver.receive_messages(
-                        max_message_count=1, max_wait_time=5
-                    )
-                    if not msgs:
-                        continue
-                    msg = msgs[0]
-                    renewer.register(
-                        receiver,
-                        msg,
-                        max_lock_renewal_duration=LOCK_RENEW_SECS
-                    )
-                    try:
-                        await process_message(msg)
-                    except Exception as exc:
-                        log_function(exc)
-                        await receiver.abandon_message(msg)
-                    else:
-                        await receiver.complete_message(msg)
+            if not msgs:
+                slots.release()
+                continue
+
+            for i, msg in enumerate(msgs):
+                if i:
+                    await slots.acquire()
+                task = asyncio.create_task(
+                    dispatch(msg, receiver, renewer, forwarder)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+
+    finally:
+        # In-flight dispatches settle before their receiver closes
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def handle_feedback(msg):
+
+    feedback = json.loads(str(msg))
+    if feedback["status"] == "charged":
+        await get_limiter().charge(feedback["deployment"])
+        return
 
-    except Exception as e:
+    await get_controller().record(
+        feedback["deployment"], feedback["status"]
+    )
+    stats.finished(
+        feedback["deployment"],
+        feedback.get("latency"),
+        feedback.get("dispatch_id"),
+    )
 
-        log_function(e)
+
+async def feedback_worker():
+
+    # Reconnects after receiver failures instead of leaving AIMD stopped
+    while True:
+
+        try:
+
+            client = ServiceBusClient.from_connection_string(CONNECTION_STR)
+            async with client:
+                receiver = client.get_queue_receiver(
+                    queue_name=FEEDBACK_QUEUE,
+                    receive_mode=ServiceBusReceiveMode.RECEIVE_AND_DELETE,
+                )
+                async with receiver:
+                    while True:
+                        msgs = await receiver.receive_messages(
+                            max_message_count=100, max_wait_time=5
+                        )
+                        for msg in msgs:
+                            # One bad message must not stop AIMD for good
+                            try:
+                                await handle_feedback(msg)
+                            except Exception as e:
+                                log_function(f"Bad feedback {msg}: {e}")
+
+        except Exception as e:
+
+            log_function(e)
+            await asyncio.sleep(FEEDBACK_RETRY_SECS)
+
+
+async def main():
+
+    get_limiter()
+    registry.install_signal_handler()
+    await asyncio.gather(worker(), feedback_worker(), registry.watch())
 
 
 if __name__ == "__main__":
 
-    asyncio.run(worker())
+    asyncio.run(main())
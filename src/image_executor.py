@@ -0,0 +1,65 @@
+import asyncio
+import base64
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from stitch_image_outside import stitch
+
+
+# "process" uses every core, "thread" keeps everything in one process
+IMAGE_EXECUTOR = os.getenv("IMAGE_EXECUTOR", "process")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 1)))
+
+_executor = None
+
+
+def get_executor():
+
+    global _executor
+
+    if _executor is None:
+        if IMAGE_EXECUTOR == "thread":
+            _executor = ThreadPoolExecutor(
+                max_workers=IMAGE_WORKERS, thread_name_prefix="image"
+            )
+        else:
+            # Forking a process that already runs an event loop and the
+            # log flusher thread is unsafe, start clean interpreters
+            _executor = ProcessPoolExecutor(
+                max_workers=IMAGE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    return _executor
+
+
+async def run_image(fn, *args):
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), fn, *args)
+
+
+def shutdown_executor():
+
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+# Everything below runs inside the executor; arguments and results are
+# plain bytes/str so they pickle cheaply across the process boundary
+
+
+def stitch_bytes(image_bytes, text, gender):
+
+    return stitch(io.BytesIO(image_bytes), text, gender).getvalue()
+
+
+def finish_page(b64_json, text, gender):
+
+    # Model output in, binary PNG of the stitched page out
+    return stitch_bytes(base64.b64decode(b64_json), text, gender)
+
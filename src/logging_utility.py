@@ -1,88 +1,325 @@
+import atexit
 import os
+import queue
+import threading
+import time
 import pytz
 from datetime import datetime
-from azure.storage.blob import BlobServiceClient, ContentSettings
-from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, BlobType, ContentSettings
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 
 
+LOG_CONTAINER_NAME = "logs"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_FLUSH_BYTES = int(os.getenv("LOG_FLUSH_BYTES", str(256 * 1024)))
+LOG_FLUSH_SECS = float(os.getenv("LOG_FLUSH_SECS", "2"))
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+# The service rejects append blocks larger than 4 MiB
+MAX_APPEND_BLOCK = 4 * 1024 * 1024
+# An append blob takes at most 50,000 blocks; move on to the next blob
+# (log.1.txt, log.2.txt, ...) a little before that
+LOG_MAX_BLOCKS = int(os.getenv("LOG_MAX_BLOCKS", "49000"))
+IST = pytz.timezone("Asia/Kolkata")
 
-def log_function(log_content,clear_file=0):
-  
-        # 💡 Replace or load this from .env
-        connection_string = os.getenv("connection_string")
-        log_container_name = "logs"
-        log_blob_name = "log_web_app_2.txt"
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        blob_client = blob_service_client.get_blob_client(log_container_name, log_blob_name)
-
-
-        if clear_file==1:
-         blob_client.upload_blob(b"", overwrite=True, content_settings=ContentSettings(content_type="text/plain"))
-    
-        log_content=str(log_content)+"\n"
-        # # download existing
-        # stream = blob_client.download_blob()
-        # existing = stream.readall()              # bytes
+_CLEAR = object()
+_STOP = object()
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+class LogSink:
+
+    def __init__(self, blob_name, prefix="", timezone=IST):
+
+        self.blob_name = blob_name
+        self.prefix = prefix
+        self.timezone = timezone
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._blob_client = None
+        self._sequence = 0
+        self._blocks = 0
+
+    def write(self, log_content, clear_file=0):
+
+        if clear_file == 1:
+            self._put(_CLEAR, block=True)
+
+        current_time = datetime.now(self.timezone).strftime(
+            "Current Time : %Y-%m-%d %H:%M:%S"
+        )
+        self._put(f"{current_time} : {self.prefix}{log_content}\n")
+
+    def flush(self, timeout=None):
+
+        if self._thread is None or self._closed:
+            return
+
+        done = threading.Event()
+        if self._put(done, block=True, timeout=timeout):
+            done.wait(timeout)
+
+    def close(self, timeout=None):
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+
+        if thread is not None:
+            # A full queue behind a stuck flusher must not hang atexit
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                return
+            thread.join(timeout)
+
+    def _put(self, item, block=False, timeout=None):
+
+        with self._lock:
+            closed = self._closed
+            if not closed and self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name=f"log-sink-{self.blob_name}",
+                    daemon=True,
+                )
+                self._thread.start()
+
+        if closed:
+            # Late lines after shutdown are written straight through
+            if isinstance(item, str):
+                self._write(item.encode("utf-8"))
+            elif item is _CLEAR:
+                self._clear()
+            return False
+
+        try:
+            self._queue.put(item, block=block, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+        return True
+
+    def _run(self):
+
+        pending = []
+        size = 0
+        deadline = None
+
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, str):
+                pending.append(item)
+                size += len(item)
+                if deadline is None:
+                    deadline = time.monotonic() + LOG_FLUSH_SECS
+                if size < LOG_FLUSH_BYTES:
+                    continue
+
+            elif item is _CLEAR:
+                pending.clear()
+                size = 0
+                deadline = None
+                self._guarded(self._clear)
+                continue
+
+            if pending:
+                self._guarded(self._write, "".join(pending).encode("utf-8"))
+                pending.clear()
+                size = 0
+            deadline = None
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is _STOP:
+                return
+
+    def _guarded(self, action, *args):
+
+        try:
+            action(*args)
+        except Exception:
+            with self._lock:
+                self.dropped += 1
+
+    def _write(self, data):
+
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            note = f"[LOGGING] dropped {dropped} lines\n"
+            data = note.encode("utf-8") + data
+
+        try:
+            for i in range(0, len(data), MAX_APPEND_BLOCK):
+                if not self._append(data[i:i + MAX_APPEND_BLOCK]):
+                    break
+            else:
+                return
+        except Exception:
+            # Reconnect on the next batch, keep this one on local disk
+            self._blob_client = None
+
+        self._write_local(data)
+
+    def _append(self, chunk):
+
+        blob_client = self._get_blob_client()
+        if blob_client is None:
+            return False
+
+        try:
+            blob_client.append_block(chunk)
+        except HttpResponseError as e:
+            # Filled up behind our count, e.g. by another instance
+            if e.error_code != "BlockCountExceedsLimit":
+                raise
+            self._roll_over()
+            self._get_blob_client().append_block(chunk)
+
+        self._blocks += 1
+        if self._blocks >= LOG_MAX_BLOCKS:
+            self._roll_over()
+
+        return True
+
+    def _roll_over(self):
+
+        self._sequence += 1
+        self._blob_client = None
+
+    def _current_name(self):
+
+        if not self._sequence:
+            return self.blob_name
+
+        root, extension = os.path.splitext(self.blob_name)
+        return f"{root}.{self._sequence}{extension}"
+
+    def _clear(self):
+
+        try:
+            blob_client = self._get_blob_client()
+            if blob_client is not None:
+                blob_client.create_append_blob(
+                    content_settings=ContentSettings(content_type="text/plain")
+                )
+                self._blocks = 0
+                return
+        except Exception:
+            self._blob_client = None
+
+        self._write_local(b"", mode="wb")
+
+    def _write_local(self, data, mode="ab"):
+
+        # Last resort: if even the local file fails the batch is counted as
+        # dropped, the flusher thread must keep running
         try:
-            existing = blob_client.download_blob().readall()
-        except ResourceNotFoundError:
-            existing = b""
-        
-        # Get IST time
-        ist = pytz.timezone("Asia/Kolkata")
-        current_time_ist = datetime.now(ist).strftime("Current Time : %Y-%m-%d %H:%M:%S")
-        
-        # File content
-        timestamp_content = f"{current_time_ist} : "
-        time_stamp_content_bytes = timestamp_content.encode("utf-8")
-        
-        # log_content = f"This is a log statement\n"
-        log_content_bytes=log_content.encode("utf-8")
-        
-        # combine and reupload
-        blob_client.upload_blob(
-            existing + time_stamp_content_bytes + log_content_bytes,
-            overwrite=True,
-            content_settings=ContentSettings(content_type="text/plain")
+            os.makedirs(LOG_DIR, exist_ok=True)
+            with open(os.path.join(LOG_DIR, self.blob_name), mode) as f:
+                f.write(data)
+        except Exception:
+            with self._lock:
+                self.dropped += data.count(b"\n")
+
+    def _get_blob_client(self):
+
+        if self._blob_client is not None:
+            return self._blob_client
+
+        connection_string = os.getenv("connection_string")
+        if not connection_string:
+            return None
+
+        blob_service_client = BlobServiceClient.from_connection_string(
+            connection_string
         )
+        content_settings = ContentSettings(content_type="text/plain")
+
+        # After a restart, skip past the blobs that are already full
+        while True:
+            blob_client = blob_service_client.get_blob_client(
+                LOG_CONTAINER_NAME, self._current_name()
+            )
+            try:
+                properties = blob_client.get_blob_properties()
+            except ResourceNotFoundError:
+                blob_client.create_append_blob(
+                    content_settings=content_settings
+                )
+                self._blocks = 0
+                break
+
+            if properties.blob_type != BlobType.APPENDBLOB:
+                # Older logs were uploaded as block blobs, carry them over
+                existing = blob_client.download_blob().readall()
+                blob_client.create_append_blob(
+                    content_settings=content_settings
+                )
+                self._blocks = 0
+                for i in range(0, len(existing), MAX_APPEND_BLOCK):
+                    blob_client.append_block(
+                        existing[i:i + MAX_APPEND_BLOCK]
+                    )
+                    self._blocks += 1
+                break
+
+            self._blocks = properties.append_blob_committed_block_count or 0
+            if self._blocks < LOG_MAX_BLOCKS:
+                break
+            self._sequence += 1
+
+        self._blob_client = blob_client
+        return blob_client
+
+
+def get_sink(blob_name, prefix="", timezone=IST):
+
+    with _sinks_lock:
+        sink = _sinks.get(blob_name)
+        if sink is None:
+            sink = LogSink(blob_name, prefix, timezone)
+            _sinks[blob_name] = sink
+
+    return sink
+
+
+def flush_logs(timeout=None):
+
+    for sink in list(_sinks.values()):
+        sink.flush(timeout)
+
+
+def shutdown_logging(timeout=10):
+
+    for sink in list(_sinks.values()):
+        sink.close(timeout)
+
+
+atexit.register(shutdown_logging)
+
+
+def log_function(log_content, clear_file=0):
+
+    get_sink("log_web_app_2.txt").write(log_content, clear_file)
 
 
 def log_moderation(log_content):
 
-    connection_string = os.getenv("connection_string")
-    log_container_name = "logs"
-    log_blob_name = "moderation.txt"
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string
-    )
-    blob_client = blob_service_client.get_blob_client(
-        log_container_name, log_blob_name
-    )
-
-    log_content = log_content + "\n"
-    # download existing
-    try:
-        stream = blob_client.download_blob()
-        existing = stream.readall()              # bytes
-    except:
-        existing = "".encode("utf-8")
-
-    # Get IST time
-    ist = pytz.timezone("Asia/Kolkata")
-    current_time_ist = datetime.now(ist).strftime(
-        "Current Time : %Y-%m-%d %H:%M:%S"
-    )
-
-    # File content
-    timestamp_content = f"{current_time_ist} : "
-    time_stamp_content_bytes = timestamp_content.encode("utf-8")
-
-    # log_content = f"This is a log statement\n"
-    log_content_bytes = log_content.encode("utf-8")
-
-    # combine and reupload
-    blob_client.upload_blob(
-        existing + time_stamp_content_bytes + log_content_bytes,
-        overwrite=True,
-        content_settings=ContentSettings(content_type="text/plain")
-    )
+    get_sink("moderation.txt").write(log_content)
@@ -1,14 +1,10 @@
-import asyncio
-import io
-import os
-import base64
-from openai import AsyncAzureOpenAI
-from azure.storage.blob.aio import BlobServiceClient
-from azure.storage.blob import ContentSettings
+import time
 from typing import List
-from async_webjob import log_function
 from logging_utility import log_moderation, log_function
-from stitch_image_outside import stitch
+from image_executor import finish_page, run_image
+from telemetry import report_result
+from upload_manager import uploads
+from openai_clients import registry
 
 
 async def multi_character_azure(payload):
@@ -27,16 +23,14 @@ async def multi_character_azure(payload):
     api_key = deployment["api_key"]
     endpoint = deployment["endpoint"]
     deployment_name = deployment["deployment-name"]
+    dispatch_id = deployment.get("dispatch_id")
 
     prompt = await get_prompt(description[0], description[1:])
     response = None
 
-    client = AsyncAzureOpenAI(
-        azure_endpoint=endpoint,
-        api_key=api_key,
-        api_version="2025-04-01-preview",
-        azure_deployment=deployment_name,
-    )
+    client = registry.image_client(endpoint, api_key, deployment_name)
+
+    start = time.monotonic()
 
     try:
 
@@ -48,9 +42,14 @@ async def multi_character_azure(payload):
             n=1,
             quality=quality,
         )
+        report_result(
+            deployment_name, time.monotonic() - start, dispatch_id=dispatch_id
+        )
 
     except Exception as e:
 
+        # Not final yet: the slot is released by the retry's report
+        report_result(deployment_name, time.monotonic() - start, e)
         log_function(e)
 
         if "403" or "429" in str(e):
@@ -75,44 +74,46 @@ async def multi_character_azure(payload):
         elif "503" in str(e):
             log_function("Engine is currently overloaded")
 
-        response = await client.images.edit(
-            model="gpt-image-1",
-            image=images,
-            prompt=await get_relaxed_prompt(description[0], description[1:]),
-            n=1,
-            quality=quality,
-            input_fidelity="high",
+        # The failed attempt already read the uploads to the end
+        for image in images:
+            image.seek(0)
+        start = time.monotonic()
+        try:
+            response = await client.images.edit(
+                model="gpt-image-1",
+                image=images,
+                prompt=await get_relaxed_prompt(description[0], description[1:]),
+                n=1,
+                quality=quality,
+                input_fidelity="high",
+            )
+        except Exception as retry_error:
+            report_result(
+                deployment_name,
+                time.monotonic() - start,
+                retry_error,
+                dispatch_id,
+            )
+            raise
+        report_result(
+            deployment_name, time.monotonic() - start, dispatch_id=dispatch_id
         )
 
     if not response:
         return None
 
-    image = response.model_dump()["data"][0]["b64_json"]
-    image = base64.b64decode(image)
-    image = io.BytesIO(image)
-    image.name = "final_image.png"
-    image = stitch(image, text_1, gender)
-    image = base64.b64encode(image.read()).decode("utf-8")
-    asyncio.create_task(upload(image, user_id, preview_id, book_id, page_num))
-
-    return image
-
-
-async def upload(image, user_id, preview_id, book_id, page_num):
-
-    connection_string = os.environ["connection_string"]
-
-    blob_service = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service.get_container_client("final-books")
-
-    blob_name = f"{user_id}/{preview_id}/{book_id}/{page_num}.png"
-    blob_client = container_client.get_blob_client(blob_name)
-
-    asyncio.create_task(blob_client.upload_blob(
-        data=image,
-        overwrite=True,
-        content_settings=ContentSettings(content_type="image/png"),
-    ))
+    # Only the b64 string is kept; it is decoded once, in the executor
+    b64_json = response.data[0].b64_json
+    response = None
+    image = await run_image(finish_page, b64_json, text_1, gender)
+    b64_json = None
+
+    return uploads.submit(
+        "final-books",
+        f"{user_id}/{preview_id}/{book_id}/{page_num}.png",
+        image,
+        "image/png",
+    )
 
 
 async def get_relaxed_prompt(desc: str, description: str):
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+import httpx
+from openai import AsyncAzureOpenAI
+from langchain_openai import AzureChatOpenAI
+
+
+OPENAI_API_VERSION = "2025-04-01-preview"
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_KEEPALIVE_SECS = float(os.getenv("OPENAI_KEEPALIVE_SECS", "120"))
+# Image edits routinely take minutes, only the connect phase is short
+OPENAI_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+OPENAI_CLIENT_IDLE_SECS = float(os.getenv("OPENAI_CLIENT_IDLE_SECS", "900"))
+
+
+class ClientRegistry:
+
+    def __init__(self, idle=OPENAI_CLIENT_IDLE_SECS):
+
+        self.idle = idle
+        self._http = None
+        # (kind, endpoint, deployment, api version)
+        #     -> [client, last used, api key]
+        self._clients = {}
+
+    def http_client(self):
+
+        # One connection pool shared by every endpoint and deployment
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                    keepalive_expiry=OPENAI_KEEPALIVE_SECS,
+                ),
+                timeout=OPENAI_TIMEOUT,
+            )
+
+        return self._http
+
+    def _get(self, key, api_key, factory):
+
+        # A rotated key in the deployment registry replaces the client
+        entry = self._clients.get(key)
+        if entry is None or entry[2] != api_key:
+            entry = [factory(), 0.0, api_key]
+            self._clients[key] = entry
+
+        entry[1] = time.monotonic()
+        return entry[0]
+
+    def image_client(self, endpoint, api_key, deployment_name,
+                     api_version=OPENAI_API_VERSION):
+
+        return self._get(
+            ("image", endpoint, deployment_name, api_version),
+            api_key,
+            lambda: AsyncAzureOpenAI(
+                azure_endpoint=endpoint,
+                api_key=api_key,
+                api_version=api_version,
+                azure_deployment=deployment_name,
+                http_client=self.http_client(),
+            ),
+        )
+
+    def chat_client(self, endpoint, api_key, deployment_name,
+                    api_version=OPENAI_API_VERSION, **kwargs):
+
+        return self._get(
+            ("chat", endpoint, deployment_name, api_version),
+            api_key,
+            lambda: AzureChatOpenAI(
+                deployment_name=deployment_name,
+                model_name=deployment_name,
+                openai_api_key=api_key,
+                openai_api_version=api_version,
+                azure_endpoint=endpoint,
+                http_async_client=self.http_client(),
+                **kwargs,
+            ),
+        )
+
+    def evict_idle(self):
+
+        # Clients only wrap the shared pool, dropping them frees nothing
+        # on the wire; the pool itself expires idle keep-alive sockets
+        cutoff = time.monotonic() - self.idle
+        for key, (_, last_used, _) in list(self._clients.items()):
+            if last_used < cutoff:
+                del self._clients[key]
+
+    async def run_eviction(self, interval=60):
+
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_idle()
+
+    async def close(self):
+
+        self._clients.clear()
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+registry = ClientRegistry()
@@ -0,0 +1,244 @@
+import asyncio
+import base64
+import io
+import os
+from collections import deque
+from azure.storage.blob import BlobBlock, ContentSettings
+from PIL import Image
+from blob_store import BLOB_BLOCK_SIZE, download, get_blob_service
+from image_executor import run_image
+
+
+# 72 maps one pixel to one point, the page size the old PIL export produced
+PDF_DPI = float(os.getenv("PDF_DPI", "72"))
+PDF_JPEG_QUALITY = int(os.getenv("PDF_JPEG_QUALITY", "90"))
+# Pages loaded/encoded ahead of the writer; bounds memory per book
+PDF_ENCODE_AHEAD = int(os.getenv("PDF_ENCODE_AHEAD", "4"))
+
+
+def encode_pdf_page(image_bytes, quality=PDF_JPEG_QUALITY):
+
+    # Runs in the image executor: any image in, baseline JPEG out
+    image = Image.open(io.BytesIO(image_bytes))
+    if image.mode in ("RGBA", "LA") or (
+        image.mode == "P" and "transparency" in image.info
+    ):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+
+    return output.getvalue(), image.width, image.height
+
+
+class PdfWriter:
+
+    # Emits a PDF as a sequence of byte chunks, one page at a time, so only
+    # the page being written is ever held; object 1 is the catalog and
+    # object 2 the page tree, both written last
+
+    def __init__(self, dpi=PDF_DPI):
+
+        self.dpi = dpi
+        self.offset = 0
+        self._offsets = {}
+        self._pages = []
+        self._next_id = 3
+
+    def _emit(self, chunks):
+
+        data = b"".join(chunks)
+        self.offset += len(data)
+        return data
+
+    def _object(self, object_id, body, stream=None):
+
+        self._offsets[object_id] = self.offset
+        chunks = [b"%d 0 obj\n" % object_id, body]
+        if stream is not None:
+            chunks += [b"\nstream\n", stream, b"\nendstream"]
+        chunks.append(b"\nendobj\n")
+        return self._emit(chunks)
+
+    def header(self):
+
+        return self._emit([b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"])
+
+    def page(self, jpeg, width, height):
+
+        image_id, content_id, page_id = range(self._next_id, self._next_id + 3)
+        self._next_id += 3
+        self._pages.append(page_id)
+
+        page_width = width * 72 / self.dpi
+        page_height = height * 72 / self.dpi
+        content = b"q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % (
+            page_width, page_height
+        )
+
+        return b"".join([
+            self._object(
+                image_id,
+                b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                b"/ColorSpace /DeviceRGB /BitsPerComponent 8 "
+                b"/Filter /DCTDecode /Length %d >>"
+                % (width, height, len(jpeg)),
+                jpeg,
+            ),
+            self._object(
+                content_id, b"<< /Length %d >>" % len(content), content
+            ),
+            self._object(
+                page_id,
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] "
+                b"/Resources << /XObject << /Im0 %d 0 R >> >> "
+                b"/Contents %d 0 R >>"
+                % (page_width, page_height, image_id, content_id),
+            ),
+        ])
+
+    def trailer(self):
+
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self._pages)
+        chunks = [
+            self._object(
+                2,
+                b"<< /Type /Pages /Kids [%s] /Count %d >>"
+                % (kids, len(self._pages)),
+            ),
+            self._object(1, b"<< /Type /Catalog /Pages 2 0 R >>"),
+        ]
+
+        xref_offset = self.offset
+        xref = [b"xref\n0 %d\n" % self._next_id, b"0000000000 65535 f \n"]
+        for object_id in range(1, self._next_id):
+            xref.append(b"%010d 00000 n \n" % self._offsets[object_id])
+        xref.append(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (self._next_id, xref_offset)
+        )
+
+        return b"".join(chunks) + self._emit(xref)
+
+
+class FileSink:
+
+    def __init__(self, path):
+
+        self._file = open(path, "wb")
+
+    async def write(self, data):
+
+        await asyncio.to_thread(self._file.write, data)
+
+    async def close(self):
+
+        await asyncio.to_thread(self._file.close)
+
+    async def abort(self):
+
+        await self.close()
+
+
+class BlobSink:
+
+    # Stages blocks as the PDF grows and commits them at the end, so the
+    # whole document never sits in memory
+
+    def __init__(self, container_name, blob_name, block_size=BLOB_BLOCK_SIZE):
+
+        self.blob_client = get_blob_service().get_blob_client(
+            container_name, blob_name
+        )
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._blocks = []
+
+    async def write(self, data):
+
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            await self._stage(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+
+    async def _stage(self, data):
+
+        block_id = base64.b64encode(
+            b"%08d" % len(self._blocks)
+        ).decode("ascii")
+        await self.blob_client.stage_block(block_id, data)
+        self._blocks.append(BlobBlock(block_id=block_id))
+
+    async def close(self):
+
+        if self._buffer:
+            await self._stage(bytes(self._buffer))
+            self._buffer.clear()
+
+        await self.blob_client.commit_block_list(
+            self._blocks,
+            content_settings=ContentSettings(content_type="application/pdf"),
+        )
+
+    async def abort(self):
+
+        # Uncommitted blocks are discarded by the service
+        self._buffer.clear()
+
+
+def blob_page(container_name, blob_path):
+
+    return lambda: download(container_name, blob_path)
+
+
+def file_page(path):
+
+    def read():
+        with open(path, "rb") as f:
+            return f.read()
+
+    return lambda: asyncio.to_thread(read)
+
+
+async def _encode(source, quality):
+
+    return await run_image(encode_pdf_page, await source(), quality)
+
+
+async def write_pdf(sources, sink, dpi=PDF_DPI, quality=PDF_JPEG_QUALITY,
+                    ahead=PDF_ENCODE_AHEAD):
+
+    # sources are callables returning page image bytes, loaded lazily;
+    # up to `ahead` pages are fetched and encoded while earlier ones are
+    # written, in order
+    writer = PdfWriter(dpi)
+    pending = deque()
+    pages = 0
+
+    try:
+        await sink.write(writer.header())
+        for source in sources:
+            pending.append(asyncio.ensure_future(_encode(source, quality)))
+            if len(pending) >= ahead:
+                await sink.write(writer.page(*await pending.popleft()))
+                pages += 1
+
+        while pending:
+            await sink.write(writer.page(*await pending.popleft()))
+            pages += 1
+
+        await sink.write(writer.trailer())
+        await sink.close()
+
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        await sink.abort()
+        raise
+
+    return pages
@@ -0,0 +1,181 @@
+import asyncio
+import os
+from collections import deque
+from rate_state import LocalRateState
+
+
+AIMD_MIN_LIMIT = int(os.getenv("AIMD_MIN_LIMIT", "1"))
+AIMD_MAX_LIMIT = int(os.getenv("AIMD_MAX_LIMIT", "10"))
+AIMD_DECREASE = float(os.getenv("AIMD_DECREASE", "0.5"))
+
+
+class RateLimitTimeout(Exception):
+
+    pass
+
+
+class RateLimiter:
+
+    def __init__(self, deployments, state=None, policy=None):
+
+        self.deployments = {
+            deployment.name: deployment.payload for deployment in deployments
+        }
+        self.configured = {
+            deployment.name: deployment.limit for deployment in deployments
+        }
+        self.state = state or LocalRateState(self.configured)
+        self.policy = policy
+        self._waiters = deque()
+
+    def __len__(self):
+
+        return len(self.deployments)
+
+    async def capacity(self):
+
+        # Most requests a single acquire() can be granted right now; AIMD and
+        # other dispatchers move the live limits below the configured ones
+        limits = await self._call(self.state.current_limits)
+        return sum(limits.values())
+
+    def next_available_at(self, n=1):
+
+        return self.state.next_available_at(n)
+
+    def try_acquire(self, n=1):
+
+        names = self.state.try_acquire(n, policy=self.policy)
+        if not names:
+            return None
+
+        return [self.deployments[name] for name in names]
+
+    def set_limit(self, name, limit):
+
+        self.state.set_limit(name, limit)
+        self.wake()
+
+    async def adapt_limit(self, name, step):
+
+        if name not in self.deployments:
+            return
+
+        if await self._call(self.state.adapt_limit, name, step):
+            self.wake()
+
+    async def charge(self, name, n=1):
+
+        # Requests made on a reservation beyond what acquire() granted
+        if name in self.deployments:
+            await self._call(self.state.charge, name, n)
+
+    def sync(self, deployments):
+
+        configured = {
+            deployment.name: deployment.limit for deployment in deployments
+        }
+        changed = {
+            name: limit
+            for name, limit in configured.items()
+            if self.configured.get(name) != limit
+        }
+
+        self.deployments = {
+            deployment.name: deployment.payload for deployment in deployments
+        }
+        self.state.sync(changed, set(configured))
+        self.configured = configured
+        self.wake()
+
+        return changed
+
+    async def _call(self, fn, *args):
+
+        # Shared backends may wait on another process's lock; keep that off
+        # the loop so lock renewal and other dispatches carry on
+        if getattr(self.state, "blocking", False):
+            return await asyncio.to_thread(fn, *args)
+
+        return fn(*args)
+
+    async def acquire(self, n=1, timeout=None):
+
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        event = asyncio.Event()
+        self._waiters.append(event)
+
+        try:
+            while True:
+                delay = None
+
+                # Only the oldest waiter may take capacity, the rest sleep
+                # until it leaves the queue
+                if self._waiters[0] is event:
+                    acquired = await self._call(self.try_acquire, n)
+                    if acquired is not None:
+                        return acquired
+                    delay = (
+                        await self._call(self.next_available_at, n)
+                        - self.state.clock()
+                    )
+                    if self.state.poll_interval is not None:
+                        delay = min(delay, self.state.poll_interval)
+                    if delay == float("inf"):
+                        delay = None
+
+                if deadline is not None:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise RateLimitTimeout(
+                            f"no capacity for {n} requests in {timeout}s"
+                        )
+                    delay = remaining if delay is None else min(
+                        delay, remaining
+                    )
+
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+        finally:
+            head = self._waiters[0] is event
+            self._waiters.remove(event)
+            if head:
+                self.wake()
+
+    def wake(self):
+
+        if self._waiters:
+            self._waiters[0].set()
+
+
+def aimd_increase(limit):
+
+    # +1 per window's worth of successful requests
+    return min(AIMD_MAX_LIMIT, limit + 1 / limit)
+
+
+def aimd_decrease(limit):
+
+    return max(AIMD_MIN_LIMIT, limit * AIMD_DECREASE)
+
+
+class AimdController:
+
+    # Keeps no limits of its own: each step is applied to the shared state,
+    # so dispatchers splitting the feedback never overwrite each other
+
+    def __init__(self, limiter):
+
+        self.limiter = limiter
+
+    async def record(self, name, status):
+
+        if status == "throttled":
+            await self.limiter.adapt_limit(name, aimd_decrease)
+        elif status == "ok":
+            await self.limiter.adapt_limit(name, aimd_increase)
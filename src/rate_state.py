@@ -0,0 +1,564 @@
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from selection import round_robin
+
+
+RATE_LIMIT = int(os.getenv("RATE_LIMIT_PER_MINUTE", "3"))
+RATE_WINDOW_SECS = float(os.getenv("RATE_WINDOW_SECS", "60"))
+RATE_STATE_BACKEND = os.getenv("RATE_STATE_BACKEND", "local")
+RATE_STATE_PATH = os.getenv("RATE_STATE_PATH", "rate_state.sqlite3")
+# Other dispatchers may take capacity behind our back, so shared backends
+# are re-polled at least this often while waiting
+RATE_POLL_SECS = float(os.getenv("RATE_POLL_SECS", "1"))
+
+
+class DeploymentBucket:
+
+    __slots__ = ("name", "limit", "adapted", "window", "stamps")
+
+    def __init__(self, name, limit=RATE_LIMIT, window=RATE_WINDOW_SECS):
+
+        self.name = name
+        self.limit = limit
+        # Fractional limit AIMD works on; `limit` is its integer part
+        self.adapted = float(limit)
+        self.window = window
+        # Ring buffer of the last `limit` dispatch times (monotonic seconds)
+        self.stamps = deque(maxlen=limit)
+
+    def next_free(self):
+
+        if len(self.stamps) < self.limit:
+            return 0.0
+
+        return self.stamps[0] + self.window
+
+    def slot_times(self):
+
+        free = self.limit - len(self.stamps)
+        return [0.0] * free + [ts + self.window for ts in self.stamps]
+
+    def free_slots(self, now):
+
+        cutoff = now - self.window
+        return self.limit - sum(1 for ts in self.stamps if ts > cutoff)
+
+
+class LocalRateState:
+
+    poll_interval = None
+    # In-process heap, cheap and not thread-safe: stays on the event loop
+    blocking = False
+
+    def __init__(self, limits, window=RATE_WINDOW_SECS):
+
+        self.window = window
+        self._heap = []
+        self._counter = itertools.count()
+        for name, limit in limits.items():
+            self._push(DeploymentBucket(name, limit, window))
+
+    def clock(self):
+
+        return time.monotonic()
+
+    def _push(self, bucket):
+
+        heapq.heappush(
+            self._heap, (bucket.next_free(), next(self._counter), bucket)
+        )
+
+    def next_available_at(self, n=1):
+
+        if not self._heap:
+            return float("inf")
+
+        if n == 1:
+            return self._heap[0][0]
+
+        times = heapq.nsmallest(
+            n,
+            (ts for _, _, bucket in self._heap for ts in bucket.slot_times())
+        )
+        if len(times) < n:
+            return float("inf")
+
+        return times[-1]
+
+    def current_limits(self):
+
+        return {bucket.name: bucket.limit for _, _, bucket in self._heap}
+
+    def sync(self, limits, names):
+
+        buckets = {
+            bucket.name: bucket
+            for _, _, bucket in self._heap
+            if bucket.name in names
+        }
+        for name, limit in limits.items():
+            bucket = buckets.get(name)
+            if bucket is None:
+                buckets[name] = DeploymentBucket(name, limit, self.window)
+            else:
+                bucket.limit = limit
+                bucket.adapted = float(limit)
+                bucket.stamps = deque(bucket.stamps, maxlen=limit)
+
+        self._heap = []
+        for bucket in buckets.values():
+            self._push(bucket)
+
+    def set_limit(self, name, limit):
+
+        for i, (_, seq, bucket) in enumerate(self._heap):
+            if bucket.name == name:
+                bucket.limit = limit
+                bucket.adapted = float(limit)
+                bucket.stamps = deque(bucket.stamps, maxlen=limit)
+                self._heap[i] = (bucket.next_free(), seq, bucket)
+                heapq.heapify(self._heap)
+                return
+
+    def adapt_limit(self, name, step):
+
+        for i, (_, seq, bucket) in enumerate(self._heap):
+            if bucket.name == name:
+                bucket.adapted = step(bucket.adapted)
+                limit = int(bucket.adapted)
+                if limit == bucket.limit:
+                    return False
+                bucket.limit = limit
+                bucket.stamps = deque(bucket.stamps, maxlen=limit)
+                self._heap[i] = (bucket.next_free(), seq, bucket)
+                heapq.heapify(self._heap)
+                return True
+
+        return False
+
+    def charge(self, name, n=1, now=None):
+
+        now = self.clock() if now is None else now
+        for i, (_, seq, bucket) in enumerate(self._heap):
+            if bucket.name == name:
+                bucket.stamps.extend([now] * n)
+                self._heap[i] = (bucket.next_free(), seq, bucket)
+                heapq.heapify(self._heap)
+                return
+
+    def try_acquire(self, n=1, now=None, policy=None):
+
+        now = self.clock() if now is None else now
+        if policy is not None:
+            return self._try_acquire_with(policy, n, now)
+
+        popped = []
+        reusable = deque()
+        taken = []
+
+        # Spread over distinct deployments first, reuse one only when every
+        # other free deployment has already been handed out
+        while len(taken) < n:
+            if self._heap and self._heap[0][0] <= now:
+                bucket = heapq.heappop(self._heap)[2]
+                popped.append(bucket)
+            elif reusable:
+                bucket = reusable.popleft()
+            else:
+                break
+
+            bucket.stamps.append(now)
+            taken.append(bucket)
+            if bucket.next_free() <= now:
+                reusable.append(bucket)
+
+        if len(taken) < n:
+            for bucket in taken:
+                bucket.stamps.pop()
+            taken = []
+
+        for bucket in popped:
+            self._push(bucket)
+
+        if not taken:
+            return None
+
+        return [bucket.name for bucket in taken]
+
+    def _try_acquire_with(self, policy, n, now):
+
+        popped = []
+        while self._heap and self._heap[0][0] <= now:
+            popped.append(heapq.heappop(self._heap)[2])
+
+        buckets = {bucket.name: bucket for bucket in popped}
+        taken = None
+        if buckets:
+            taken = policy(
+                {
+                    name: bucket.free_slots(now)
+                    for name, bucket in buckets.items()
+                },
+                n,
+            )
+
+        for name in taken or ():
+            buckets[name].stamps.append(now)
+
+        for bucket in popped:
+            self._push(bucket)
+
+        return taken
+
+
+def pick_deployments(limits, stamps, n, policy=None):
+
+    # Least recently used first, so the default round-robin prefers distinct
+    # deployments over a second slot on the same one
+    order = sorted(
+        limits, key=lambda name: stamps[name][-1] if stamps.get(name) else 0.0
+    )
+    candidates = {
+        name: limits[name] - len(stamps.get(name, ())) for name in order
+    }
+
+    return (policy or round_robin)(candidates, n)
+
+
+def nth_free_time(limits, stamps, n, window):
+
+    times = heapq.nsmallest(
+        n,
+        (
+            ts
+            for name, limit in limits.items()
+            for ts in (
+                [0.0] * (limit - len(stamps.get(name, ())))
+                + [ts + window for ts in stamps.get(name, ())]
+            )
+        )
+    )
+    if len(times) < n:
+        return float("inf")
+
+    return times[-1]
+
+
+class SQLiteRateState:
+
+    poll_interval = RATE_POLL_SECS
+    # Lock waits of up to the busy timeout: callers run it in a thread
+    blocking = True
+
+    def __init__(self, limits, path=RATE_STATE_PATH, window=RATE_WINDOW_SECS):
+
+        self.names = set(limits)
+        self.window = window
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits "
+            "(name TEXT PRIMARY KEY, max_requests INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS adaptive_limits "
+            "(name TEXT PRIMARY KEY, value REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dispatches "
+            "(name TEXT NOT NULL, ts REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS dispatches_name_ts "
+            "ON dispatches (name, ts)"
+        )
+
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO rate_limits (name, max_requests) "
+                "VALUES (?, ?)",
+                list(limits.items()),
+            )
+
+    def clock(self):
+
+        return time.time()
+
+    @contextmanager
+    def _transaction(self):
+
+        # BEGIN IMMEDIATE takes the write lock up front, so the read of
+        # current usage and the insert of new dispatches are atomic across
+        # processes
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _load(self, conn, now, prune=True):
+
+        cutoff = now - self.window
+        if prune:
+            conn.execute("DELETE FROM dispatches WHERE ts <= ?", (cutoff,))
+        limits = {
+            name: limit
+            for name, limit in conn.execute(
+                "SELECT name, max_requests FROM rate_limits"
+            )
+            if name in self.names
+        }
+        stamps = {}
+        for name, ts in conn.execute(
+            "SELECT name, ts FROM dispatches WHERE ts > ? ORDER BY ts",
+            (cutoff,),
+        ):
+            stamps.setdefault(name, []).append(ts)
+
+        return limits, stamps
+
+    def next_available_at(self, n=1):
+
+        # Read-only: WAL readers never wait on the write lock, so polling
+        # waiters do not contend with dispatchers taking capacity
+        with self._lock:
+            limits, stamps = self._load(self._conn, self.clock(), prune=False)
+
+        return nth_free_time(limits, stamps, n, self.window)
+
+    def current_limits(self):
+
+        with self._lock:
+            return {
+                name: limit
+                for name, limit in self._conn.execute(
+                    "SELECT name, max_requests FROM rate_limits"
+                )
+                if name in self.names
+            }
+
+    def sync(self, limits, names):
+
+        self.names = set(names)
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO rate_limits (name, max_requests) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET "
+                "max_requests = excluded.max_requests",
+                list(limits.items()),
+            )
+            # Configured changes restart adaptation from the new limit
+            conn.executemany(
+                "DELETE FROM adaptive_limits WHERE name = ?",
+                [(name,) for name in limits],
+            )
+
+    def set_limit(self, name, limit):
+
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE rate_limits SET max_requests = ? WHERE name = ?",
+                (limit, name),
+            )
+            conn.execute(
+                "DELETE FROM adaptive_limits WHERE name = ?", (name,)
+            )
+
+    def adapt_limit(self, name, step):
+
+        # Read-modify-write under the write lock: every dispatcher sharing
+        # the file adjusts the same value
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT r.max_requests, a.value FROM rate_limits r "
+                "LEFT JOIN adaptive_limits a ON a.name = r.name "
+                "WHERE r.name = ?",
+                (name,),
+            ).fetchone()
+            if row is None:
+                return False
+
+            limit, adapted = row
+            adapted = step(float(limit) if adapted is None else adapted)
+            conn.execute(
+                "INSERT INTO adaptive_limits (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+                (name, adapted),
+            )
+            if int(adapted) == limit:
+                return False
+
+            conn.execute(
+                "UPDATE rate_limits SET max_requests = ? WHERE name = ?",
+                (int(adapted), name),
+            )
+            return True
+
+    def charge(self, name, n=1, now=None):
+
+        now = self.clock() if now is None else now
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO dispatches (name, ts) VALUES (?, ?)",
+                [(name, now)] * n,
+            )
+
+    def try_acquire(self, n=1, now=None, policy=None):
+
+        now = self.clock() if now is None else now
+
+        with self._transaction() as conn:
+            limits, stamps = self._load(conn, now)
+            taken = pick_deployments(limits, stamps, n, policy)
+            if taken:
+                conn.executemany(
+                    "INSERT INTO dispatches (name, ts) VALUES (?, ?)",
+                    [(name, now) for name in taken],
+                )
+
+        return taken
+
+
+class MemoryStore:
+
+    # Local stand-in for a network key-value store with atomic multi-key
+    # transactions (e.g. a Redis WATCH/MULTI block)
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._data = {"limits": {}, "adapted": {}, "dispatches": {}}
+
+    @contextmanager
+    def transaction(self):
+
+        with self._lock:
+            yield self._data
+
+
+class StoreRateState:
+
+    poll_interval = RATE_POLL_SECS
+    blocking = True
+
+    def __init__(self, limits, store, window=RATE_WINDOW_SECS):
+
+        self.names = set(limits)
+        self.window = window
+        self.store = store
+
+        with store.transaction() as data:
+            for name, limit in limits.items():
+                data["limits"].setdefault(name, limit)
+
+    def clock(self):
+
+        return time.time()
+
+    def _load(self, data, now, prune=True):
+
+        cutoff = now - self.window
+        limits = {
+            name: limit
+            for name, limit in data["limits"].items()
+            if name in self.names
+        }
+        stamps = {}
+        for name in limits:
+            live = [
+                ts for ts in data["dispatches"].get(name, ()) if ts > cutoff
+            ]
+            if prune:
+                data["dispatches"][name] = live
+            stamps[name] = live
+
+        return limits, stamps
+
+    def next_available_at(self, n=1):
+
+        with self.store.transaction() as data:
+            limits, stamps = self._load(data, self.clock(), prune=False)
+            return nth_free_time(limits, stamps, n, self.window)
+
+    def current_limits(self):
+
+        with self.store.transaction() as data:
+            return {
+                name: limit
+                for name, limit in data["limits"].items()
+                if name in self.names
+            }
+
+    def sync(self, limits, names):
+
+        self.names = set(names)
+        with self.store.transaction() as data:
+            data["limits"].update(limits)
+            for name in limits:
+                data["adapted"].pop(name, None)
+
+    def set_limit(self, name, limit):
+
+        with self.store.transaction() as data:
+            data["limits"][name] = limit
+            data["adapted"].pop(name, None)
+
+    def adapt_limit(self, name, step):
+
+        with self.store.transaction() as data:
+            limit = data["limits"].get(name)
+            if limit is None:
+                return False
+
+            adapted = step(data["adapted"].get(name, float(limit)))
+            data["adapted"][name] = adapted
+            if int(adapted) == limit:
+                return False
+
+            data["limits"][name] = int(adapted)
+            return True
+
+    def charge(self, name, n=1, now=None):
+
+        now = self.clock() if now is None else now
+        with self.store.transaction() as data:
+            data["dispatches"].setdefault(name, []).extend([now] * n)
+
+    def try_acquire(self, n=1, now=None, policy=None):
+
+        now = self.clock() if now is None else now
+
+        with self.store.transaction() as data:
+            limits, stamps = self._load(data, now)
+            taken = pick_deployments(limits, stamps, n, policy)
+            for name in taken or ():
+                stamps[name].append(now)
+
+        return taken
+
+
+_memory_store = MemoryStore()
+
+
+def get_rate_state(limits):
+
+    if RATE_STATE_BACKEND == "sqlite":
+        return SQLiteRateState(limits)
+
+    if RATE_STATE_BACKEND == "memory":
+        return StoreRateState(limits, _memory_store)
+
+    return LocalRateState(limits)
@@ -0,0 +1,94 @@
+import io
+import os
+from PIL import Image, ImageOps
+
+try:
+    # AVIF decoding for Pillow builds without native support
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+
+# gpt-image-1 and the vision model gain nothing from larger portraits
+REFERENCE_MAX_SIDE = int(os.getenv("REFERENCE_MAX_SIDE", "1024"))
+REFERENCE_JPEG_QUALITY = int(os.getenv("REFERENCE_JPEG_QUALITY", "90"))
+# Uploads already this small, upright and in an accepted format pass through
+REFERENCE_PASSTHROUGH_BYTES = int(
+    os.getenv("REFERENCE_PASSTHROUGH_BYTES", str(512 * 1024))
+)
+
+MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+    "gif": "image/gif",
+    "bmp": "image/bmp",
+    "tiff": "image/tiff",
+    "avif": "image/avif",
+    "heic": "image/heic",
+}
+# Formats images.edit accepts as-is
+ACCEPTED_FORMATS = ("jpeg", "png", "webp")
+EXIF_ORIENTATION = 0x0112
+
+
+def sniff_format(data):
+
+    # Trust the bytes, not the file extension
+    head = bytes(data[:16])
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "webp"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if head.startswith(b"BM"):
+        return "bmp"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "tiff"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in (b"avif", b"avis"):
+            return "avif"
+        if brand in (b"heic", b"heix", b"mif1", b"msf1"):
+            return "heic"
+
+    return None
+
+
+def mime_type(data):
+
+    return MIME_TYPES.get(sniff_format(data), "image/jpeg")
+
+
+def normalize_reference(data):
+
+    # Runs in the image executor: bytes in, (bytes, extension) out
+    fmt = sniff_format(data)
+    image = Image.open(io.BytesIO(data))
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+
+    if (
+        fmt in ACCEPTED_FORMATS
+        and orientation == 1
+        and len(data) <= REFERENCE_PASSTHROUGH_BYTES
+        and max(image.size) <= REFERENCE_MAX_SIDE
+    ):
+        return data, "jpg" if fmt == "jpeg" else fmt
+
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((REFERENCE_MAX_SIDE, REFERENCE_MAX_SIDE), Image.LANCZOS)
+
+    output = io.BytesIO()
+    if image.mode in ("RGBA", "LA") or (
+        image.mode == "P" and "transparency" in image.info
+    ):
+        image.save(output, format="PNG", optimize=True)
+        return output.getvalue(), "png"
+
+    image.convert("RGB").save(
+        output, format="JPEG", quality=REFERENCE_JPEG_QUALITY, optimize=True
+    )
+    return output.getvalue(), "jpg"
@@ -0,0 +1,182 @@
+import os
+import random
+import time
+
+
+SELECTION_POLICY = os.getenv("SELECTION_POLICY", "round-robin")
+EWMA_ALPHA = float(os.getenv("EWMA_ALPHA", "0.2"))
+# Slots whose feedback never arrives (job died before generating, or the
+# feedback went to another dispatcher) stop counting after this long
+STATS_SLOT_TTL = float(os.getenv("STATS_SLOT_TTL", "1800"))
+
+
+class DeploymentStats:
+
+    def __init__(self, alpha=EWMA_ALPHA, slot_ttl=STATS_SLOT_TTL):
+
+        self.alpha = alpha
+        self.slot_ttl = slot_ttl
+        self.latency = {}
+        self.outstanding = {}
+        # dispatch id -> (deployment name, start time), oldest first
+        self._slots = {}
+
+    def started(self, slots):
+
+        # slots are (dispatch id, deployment name) pairs
+        self.expire()
+        now = time.monotonic()
+        for dispatch_id, name in slots:
+            self._slots[dispatch_id] = (name, now)
+            self.outstanding[name] = self.outstanding.get(name, 0) + 1
+
+    def _release(self, dispatch_id):
+
+        slot = self._slots.pop(dispatch_id, None)
+        if slot is not None:
+            name = slot[0]
+            self.outstanding[name] = max(self.outstanding.get(name, 0) - 1, 0)
+
+    def abandon(self, dispatch_ids):
+
+        for dispatch_id in dispatch_ids:
+            self._release(dispatch_id)
+
+    def expire(self):
+
+        cutoff = time.monotonic() - self.slot_ttl
+        for dispatch_id, (_, started) in list(self._slots.items()):
+            if started > cutoff:
+                break
+            self._release(dispatch_id)
+
+    def finished(self, name, latency=None, dispatch_id=None):
+
+        # Only a slot this instance handed out is released, and only once;
+        # latency is learned from every report
+        if dispatch_id is not None:
+            self._release(dispatch_id)
+        self.expire()
+
+        if latency is None:
+            return
+
+        previous = self.latency.get(name)
+        if previous is None:
+            self.latency[name] = latency
+        else:
+            self.latency[name] = (
+                self.alpha * latency + (1 - self.alpha) * previous
+            )
+
+    def expected_latency(self, name):
+
+        latency = self.latency.get(name)
+        if latency is not None:
+            return latency
+
+        # Unmeasured deployments look average so they still get probed
+        if self.latency:
+            return sum(self.latency.values()) / len(self.latency)
+
+        return 1.0
+
+    def score(self, name, extra=0):
+
+        outstanding = self.outstanding.get(name, 0) + extra
+        return self.expected_latency(name) * (outstanding + 1)
+
+
+def round_robin(candidates, n):
+
+    free = dict(candidates)
+    taken = []
+
+    while len(taken) < n:
+        progress = False
+        for name in free:
+            if free[name] > 0 and len(taken) < n:
+                free[name] -= 1
+                taken.append(name)
+                progress = True
+        if not progress:
+            return None
+
+    return taken
+
+
+class ScoredPolicy:
+
+    def __init__(self, stats):
+
+        self.stats = stats
+
+    def choose(self, names, extra):
+
+        raise NotImplementedError
+
+    def __call__(self, candidates, n):
+
+        self.stats.expire()
+        free = dict(candidates)
+        # Slots handed out in this call count as outstanding, which spreads
+        # a multi-slot request over deployments
+        extra = dict.fromkeys(free, 0)
+        taken = []
+
+        while len(taken) < n:
+            names = [name for name in free if free[name] > 0]
+            if not names:
+                return None
+            name = self.choose(names, extra)
+            free[name] -= 1
+            extra[name] += 1
+            taken.append(name)
+
+        return taken
+
+
+class LeastOutstanding(ScoredPolicy):
+
+    def choose(self, names, extra):
+
+        return min(
+            names,
+            key=lambda name: self.stats.outstanding.get(name, 0) + extra[name]
+        )
+
+
+class EwmaWeighted(ScoredPolicy):
+
+    def choose(self, names, extra):
+
+        weights = [1 / self.stats.score(name, extra[name]) for name in names]
+        return random.choices(names, weights=weights)[0]
+
+
+class PowerOfTwoChoices(ScoredPolicy):
+
+    def choose(self, names, extra):
+
+        if len(names) == 1:
+            return names[0]
+
+        return min(
+            random.sample(names, 2),
+            key=lambda name: self.stats.score(name, extra[name])
+        )
+
+
+POLICIES = {
+    "least-outstanding": LeastOutstanding,
+    "ewma": EwmaWeighted,
+    "p2c": PowerOfTwoChoices,
+}
+
+
+def get_policy(stats, name=SELECTION_POLICY):
+
+    if name not in POLICIES:
+        return None
+
+    return POLICIES[name](stats)
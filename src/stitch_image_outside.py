@@ -1,6 +1,25 @@
 from PIL import Image, ImageDraw, ImageFont
 import io
+import os
+import re
 import html.parser
+import math
+from functools import lru_cache
+
+
+STITCH_FONT_SIZE = 30
+# TrueType files for each style; unset styles fall back to Pillow's font
+STITCH_FONTS = {
+    "regular": os.getenv("STITCH_FONT_REGULAR"),
+    "bold": os.getenv("STITCH_FONT_BOLD"),
+    "italic": os.getenv("STITCH_FONT_ITALIC"),
+    "bold_italic": os.getenv("STITCH_FONT_BOLD_ITALIC"),
+}
+# Horizontal shear for italic runs drawn without an italic face
+ITALIC_SLANT = float(os.getenv("STITCH_ITALIC_SLANT", "0.2"))
+LINE_SPACING = 5
+BLOCK_TAGS = ("p", "div", "li")
+LINE_BREAK = None
 
 
 class HTMLTextParser(html.parser.HTMLParser):
@@ -13,42 +32,236 @@ class HTMLTextParser(html.parser.HTMLParser):
 
     def handle_starttag(self, tag, attrs):
 
+        if tag == "br":
+            self.text_segments.append((LINE_BREAK, []))
+            return
+
         self.current_styles.append(tag)
 
     def handle_endtag(self, tag):
 
         if tag in self.current_styles:
             self.current_styles.remove(tag)
+        if tag in BLOCK_TAGS:
+            self.text_segments.append((LINE_BREAK, []))
 
     def handle_data(self, data):
 
-        self.text_segments.append((data.strip(), self.current_styles.copy()))
+        # Whitespace is kept: "<b>Tom</b>, hi" must not become "Tom , hi"
+        self.text_segments.append((data, self.current_styles.copy()))
 
 
-def wrap_text(text, max_width, fonts, draw):
+def style_of(styles):
 
-    lines = []
-    words = text.split()
-    current_line = ""
-    current_styles = []
+    bold = "strong" in styles or "b" in styles
+    italic = "em" in styles or "i" in styles
+    if bold and italic:
+        return "bold_italic"
+    if bold:
+        return "bold"
+    if italic:
+        return "italic"
+    return "regular"
 
-    for word in words:
-        test_line = current_line + word + " "
-        bbox = draw.textbbox((0, 0), test_line, font=fonts['regular'])
-        text_width = bbox[2] - bbox[0]
 
-        if text_width <= max_width:
-            current_line = test_line
-        else:
-            if current_line:
-                lines.append((current_line.strip(), current_styles))
-            current_line = word + " "
-            current_styles = []
+@lru_cache(maxsize=None)
+def get_font(style, size):
+
+    # Returns (font, stroke, slant); a style without its own face is drawn
+    # from the nearest one, stroked for bold and sheared for italic
+    path = STITCH_FONTS[style]
+    if path:
+        return ImageFont.truetype(path, size), 0, 0.0
+
+    if style == "bold_italic":
+        if STITCH_FONTS["bold"] or not STITCH_FONTS["italic"]:
+            font, stroke, _ = get_font("bold", size)
+            return font, stroke, ITALIC_SLANT
+        font, _, slant = get_font("italic", size)
+        return font, 1, slant
+
+    if style == "bold":
+        font, _, _ = get_font("regular", size)
+        return font, 1, 0.0
+
+    if style == "italic":
+        font, _, _ = get_font("regular", size)
+        return font, 0, ITALIC_SLANT
+
+    if STITCH_FONTS["regular"]:
+        return ImageFont.truetype(STITCH_FONTS["regular"], size), 0, 0.0
+
+    return ImageFont.load_default(size=size), 0, 0.0
+
+
+@lru_cache(maxsize=65536)
+def word_width(style, size, word):
+
+    font, stroke, _ = get_font(style, size)
+    return font.getlength(word) + 2 * stroke
+
+
+@lru_cache(maxsize=None)
+def line_height(style, size):
+
+    font, stroke, _ = get_font(style, size)
+    ascent, descent = font.getmetrics()
+    return ascent + descent + 2 * stroke
+
+
+@lru_cache(maxsize=4096)
+def slanted_mask(text, style, size):
+
+    # The run is drawn upright into a mask, then sheared about its
+    # baseline; returns the mask and how far it reaches left of the run
+    font, stroke, slant = get_font(style, size)
+    ascent, _ = font.getmetrics()
+    height = line_height(style, size)
+    baseline = ascent + stroke
+    pad = math.ceil(slant * (height - baseline))
+    mask = Image.new(
+        "L",
+        (math.ceil(word_width(style, size, text) + pad + slant * baseline),
+         height),
+        0,
+    )
+    ImageDraw.Draw(mask).text(
+        (stroke, stroke),
+        text,
+        fill=255,
+        font=font,
+        stroke_width=stroke,
+        stroke_fill=255,
+    )
+
+    mask = mask.transform(
+        mask.size,
+        Image.Transform.AFFINE,
+        (1, slant, -pad - slant * baseline, 0, 1, 0),
+        resample=Image.Resampling.BICUBIC,
+    )
+
+    return mask, pad
+
+
+class TextLayout:
+
+    # runs are (x, y, text, style) relative to the top-left of the text box
 
-    if current_line:
-        lines.append((current_line.strip(), current_styles))
+    __slots__ = ("runs", "width", "height", "size")
 
-    return lines
+    def __init__(self, runs, width, height, size):
+
+        self.runs = runs
+        self.width = width
+        self.height = height
+        self.size = size
+
+    def draw(self, draw, origin, fill):
+
+        for x, y, text, style in self.runs:
+            font, stroke, slant = get_font(style, self.size)
+            if slant:
+                mask, pad = slanted_mask(text, style, self.size)
+                draw.bitmap(
+                    (
+                        int(round(origin[0] + x)) - stroke - pad,
+                        int(round(origin[1] + y)) - stroke,
+                    ),
+                    mask,
+                    fill=fill,
+                )
+                continue
+
+            draw.text(
+                (origin[0] + x, origin[1] + y),
+                text,
+                fill=fill,
+                font=font,
+                stroke_width=stroke,
+                stroke_fill=fill,
+            )
+
+
+@lru_cache(maxsize=1024)
+def layout_text(text, max_width, size=STITCH_FONT_SIZE):
+
+    # One pass over the words using cached advance widths; a word wider
+    # than max_width gets a line of its own
+    parser = HTMLTextParser()
+    parser.feed(text)
+    parser.close()
+
+    # Words are lists of (text, style) pieces; text nodes that touch with
+    # no whitespace between them form one unbreakable word
+    words = []
+    gap = True
+    for segment, styles in parser.text_segments:
+        if segment is LINE_BREAK:
+            words.append(LINE_BREAK)
+            gap = True
+            continue
+
+        style = style_of(styles)
+        for token in re.split(r"(\s+)", segment):
+            if not token:
+                continue
+            if token.isspace():
+                gap = True
+            elif gap or not words or words[-1] is LINE_BREAK:
+                words.append([(token, style)])
+                gap = False
+            else:
+                words[-1].append((token, style))
+
+    runs = []
+    lines = []
+    line = []
+    x = 0
+
+    for word in words:
+        if word is LINE_BREAK:
+            if line:
+                lines.append((x, line))
+            line = []
+            x = 0
+            continue
+
+        width = sum(word_width(style, size, text) for text, style in word)
+        space = word_width(word[0][1], size, " ")
+        if line and x + space + width > max_width:
+            lines.append((x, line))
+            line = []
+            x = 0
+        if line:
+            x += space
+
+        # Each piece records whether a space separates it from the last
+        for i, (text, style) in enumerate(word):
+            line.append((x, text, style, i == 0 and bool(line)))
+            x += word_width(style, size, text)
+
+    if line:
+        lines.append((x, line))
+
+    y = 0
+    width = 0
+    for line_width, pieces in lines:
+        width = max(width, line_width)
+        # Adjacent pieces of one style are drawn as a single run
+        start, text, style, _ = pieces[0]
+        for piece_x, piece, piece_style, spaced in pieces[1:]:
+            if piece_style == style:
+                text += (" " if spaced else "") + piece
+            else:
+                runs.append((start, y, text, style))
+                start, text, style = piece_x, piece, piece_style
+        runs.append((start, y, text, style))
+        y += max(line_height(p[2], size) for p in pieces) + LINE_SPACING
+
+    return TextLayout(
+        tuple(runs), int(round(width)), max(y - LINE_SPACING, 0), size
+    )
 
 
 def stitch(image, text, gender):
@@ -72,7 +285,6 @@ def stitch(image, text, gender):
     text_color = (0, 0, 0)  # Black text
     background_color = (255, 255, 255, 255)  # Opaque white background
     position = (10, 10)  # Position for text in the new top area
-    font_size = 30
     padding = 10
 
     # Open original image
@@ -80,46 +292,11 @@ def stitch(image, text, gender):
     if original_image.mode != "RGBA":
         original_image = original_image.convert("RGBA")
 
-    # Load fonts (replace with actual font files)
-    fonts = {
-        'regular': ImageFont.load_default(size=font_size),
-        'bold': ImageFont.load_default(size=font_size),
-        'italic': ImageFont.load_default(size=font_size),
-        'bold_italic': ImageFont.load_default(size=font_size)
-    }
-
-    # Parse HTML
-    parser = HTMLTextParser()
-    parser.feed(text)
-    parser.close()
-
-    # Calculate text dimensions
+    # Lay out the caption, reused for any page with the same text and width
     max_width = original_image.width - position[0] - padding - 10
-    temp_image = Image.new("RGBA", (original_image.width, 1000))
-    draw = ImageDraw.Draw(temp_image)
-    text_height = 0
-    text_width = 0
-    lines_with_styles = []
-    for segment, styles in parser.text_segments:
-        if not segment:
-            continue
-        font_key = 'regular'
-        if 'strong' in styles and 'em' in styles:
-            font_key = 'bold_italic'
-        elif 'strong' in styles:
-            font_key = 'bold'
-        elif 'em' in styles:
-            font_key = 'italic'
-        font = fonts[font_key]
-        lines = wrap_text(segment, max_width, fonts, draw)
-        for line, _ in lines:
-            bbox = draw.textbbox((0, 0), line, font=font)
-            line_width = bbox[2] - bbox[0]
-            line_height = bbox[3] - bbox[1]
-            text_width = max(text_width, line_width)
-            text_height += line_height + 5
-            lines_with_styles.append((line, font))
-    text_height = max(text_height - 5, 0)
+    layout = layout_text(text, max_width)
+    text_width = layout.width
+    text_height = layout.height
 
     # Create new image with extra space for text
     total_height = text_height + 2 * padding + original_image.height
@@ -138,12 +315,7 @@ def stitch(image, text, gender):
     draw.rectangle(background_rect, fill=background_color)
 
     # Draw text
-    y = position[1]
-    for line, font in lines_with_styles:
-        draw.text((position[0], y), line, fill=text_color, font=font)
-        bbox = draw.textbbox((0, 0), line, font=font)
-        line_height = bbox[3] - bbox[1]
-        y += line_height + 5
+    layout.draw(draw, position, text_color)
 
     # Paste original image below text area
     new_image.paste(original_image, (0, text_height + 2 * padding))
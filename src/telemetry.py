@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+import time
+from azure.servicebus.aio import ServiceBusClient
+from azure.servicebus import ServiceBusMessage
+from logging_utility import log_function
+
+
+FEEDBACK_QUEUE = os.getenv("FEEDBACK_QUEUE", "rate_feedback")
+TELEMETRY_QUEUE_SIZE = int(os.getenv("TELEMETRY_QUEUE_SIZE", "1000"))
+TELEMETRY_BATCH = 100
+TELEMETRY_RETRY_SECS = float(os.getenv("TELEMETRY_RETRY_SECS", "1"))
+TELEMETRY_MAX_RETRY_SECS = float(os.getenv("TELEMETRY_MAX_RETRY_SECS", "60"))
+
+_pending = None
+_sender_task = None
+
+
+def classify_error(error):
+
+    if error is None:
+        return "ok"
+
+    message = str(error)
+    if "429" in message or "503" in message:
+        return "throttled"
+
+    return "error"
+
+
+def report_result(deployment_name, latency, error=None, dispatch_id=None):
+
+    # dispatch_id is sent with the final attempt of a dispatched slot only,
+    # so the dispatcher releases each slot exactly once
+    _enqueue({
+        "deployment": deployment_name,
+        "status": classify_error(error),
+        "latency": latency,
+        "dispatch_id": dispatch_id,
+        "time": time.time(),
+    })
+
+
+def report_charge(deployment_name):
+
+    # A page run on a reserved slot after the slot's first page is a
+    # request acquire() never granted; the dispatcher charges it
+    _enqueue({
+        "deployment": deployment_name,
+        "status": "charged",
+        "time": time.time(),
+    })
+
+
+def _enqueue(feedback):
+
+    global _pending, _sender_task
+
+    if _pending is None:
+        _pending = asyncio.Queue(maxsize=TELEMETRY_QUEUE_SIZE)
+        _sender_task = asyncio.create_task(_send_loop())
+
+    try:
+        _pending.put_nowait(json.dumps(feedback))
+    except asyncio.QueueFull:
+        # Feedback is advisory, never hold up generation for it
+        pass
+
+
+async def _send_loop():
+
+    # Reconnects with backoff: if this task died, report_result would fill
+    # the queue and then drop all feedback without a word
+    failures = 0
+
+    while True:
+
+        try:
+
+            client = ServiceBusClient.from_connection_string(
+                os.environ["SERVICE_BUS"]
+            )
+            async with client:
+                sender = client.get_queue_sender(queue_name=FEEDBACK_QUEUE)
+                async with sender:
+                    failures = 0
+                    await _send_batches(sender)
+
+        except Exception as e:
+
+            log_function(f"Telemetry sender failed: {e}")
+            await asyncio.sleep(
+                min(TELEMETRY_RETRY_SECS * 2 ** failures,
+                    TELEMETRY_MAX_RETRY_SECS)
+            )
+            failures += 1
+
+
+async def _send_batches(sender):
+
+    while True:
+        items = [await _pending.get()]
+        while not _pending.empty() and len(items) < TELEMETRY_BATCH:
+            items.append(_pending.get_nowait())
+
+        try:
+            await sender.send_messages(
+                [ServiceBusMessage(item) for item in items]
+            )
+        except Exception as e:
+            log_function(e)
+        finally:
+            for _ in items:
+                _pending.task_done()
+
+
+async def close_telemetry(timeout=5):
+
+    global _pending, _sender_task
+
+    if _sender_task is None:
+        return
+
+    try:
+        await asyncio.wait_for(_pending.join(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+    _sender_task.cancel()
+    _pending = None
+    _sender_task = None
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from blob_store import download_if_modified
+from logging_utility import log_function
+
+
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", "template_cache")
+TEMPLATE_CACHE_MEMORY_BYTES = int(
+    os.getenv("TEMPLATE_CACHE_MEMORY_BYTES", str(256 * 1024 * 1024))
+)
+TEMPLATE_CACHE_DISK_BYTES = int(
+    os.getenv("TEMPLATE_CACHE_DISK_BYTES", str(2 * 1024 * 1024 * 1024))
+)
+# How long a cached copy is served before its ETag is checked again
+TEMPLATE_CACHE_REVALIDATE_SECS = float(
+    os.getenv("TEMPLATE_CACHE_REVALIDATE_SECS", "300")
+)
+
+
+class CacheEntry:
+
+    __slots__ = ("data", "etag", "last_modified", "checked")
+
+    def __init__(self, data, etag, last_modified, checked):
+
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked = checked
+
+
+class TemplateCache:
+
+    def __init__(self, directory=TEMPLATE_CACHE_DIR,
+                 memory_bytes=TEMPLATE_CACHE_MEMORY_BYTES,
+                 disk_bytes=TEMPLATE_CACHE_DISK_BYTES,
+                 revalidate=TEMPLATE_CACHE_REVALIDATE_SECS):
+
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.revalidate = revalidate
+        self.stats = Counter()
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        # file stem -> size, least recently used first
+        self._disk = None
+        self._disk_used = 0
+        self._disk_lock = threading.Lock()
+        self._loading = {}
+
+    async def get(self, container_name, blob_path):
+
+        key = f"{container_name}/{blob_path}"
+
+        entry = self._memory.get(key)
+        if entry is not None and self._fresh(entry):
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return entry.data
+
+        # Concurrent jobs asking for the same page share one fetch
+        loading = self._loading.get(key)
+        if loading is None:
+            loading = asyncio.ensure_future(
+                self._load(key, container_name, blob_path, entry)
+            )
+            self._loading[key] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(key, None))
+
+        return await asyncio.shield(loading)
+
+    def _fresh(self, entry):
+
+        return time.time() - entry.checked < self.revalidate
+
+    async def _load(self, key, container_name, blob_path, entry):
+
+        if entry is None:
+            entry = await self._disk_tier(self._read_disk, key)
+            if entry is not None and self._fresh(entry):
+                self.stats["disk_hits"] += 1
+                self._remember(key, entry)
+                return entry.data
+
+        data, properties = await download_if_modified(
+            container_name, blob_path, entry.etag if entry else None
+        )
+
+        changed = data is not None
+        if not changed:
+            self.stats["revalidated"] += 1
+            entry.checked = time.time()
+        else:
+            self.stats["misses"] += 1
+            entry = CacheEntry(
+                data,
+                properties.etag,
+                str(properties.last_modified),
+                time.time(),
+            )
+
+        self._remember(key, entry)
+        await self._disk_tier(self._write_disk, key, entry, changed)
+        return entry.data
+
+    async def _disk_tier(self, fn, *args):
+
+        # A full, read-only or missing cache directory only loses the disk
+        # tier; the downloaded template is still served
+        try:
+            return await asyncio.to_thread(fn, *args)
+        except OSError as e:
+            self.stats["disk_errors"] += 1
+            log_function(f"Template disk cache failed: {e}")
+            return None
+
+    def _remember(self, key, entry):
+
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= len(previous.data)
+
+        if len(entry.data) > self.memory_bytes:
+            return
+
+        self._memory[key] = entry
+        self._memory_used += len(entry.data)
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted.data)
+            self.stats["memory_evictions"] += 1
+
+    def _paths(self, key):
+
+        stem = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, stem)
+        return stem, base + ".bin", base + ".json"
+
+    def _scan_disk(self):
+
+        if self._disk is not None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".bin"):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_atime, name[:-4], stat.st_size))
+
+        self._disk = OrderedDict(
+            (stem, size) for _, stem, size in sorted(files)
+        )
+        self._disk_used = sum(self._disk.values())
+
+    def _read_disk(self, key):
+
+        with self._disk_lock:
+            return self._read_disk_locked(key)
+
+    def _write_disk(self, key, entry, changed):
+
+        with self._disk_lock:
+            self._write_disk_locked(key, entry, changed)
+
+    def _read_disk_locked(self, key):
+
+        self._scan_disk()
+        stem, data_path, meta_path = self._paths(key)
+        if stem not in self._disk:
+            return None
+
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(data_path, "rb") as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+
+        self._disk.move_to_end(stem)
+        return CacheEntry(
+            data, meta["etag"], meta["last_modified"], meta["checked"]
+        )
+
+    def _write_disk_locked(self, key, entry, changed):
+
+        self._scan_disk()
+        stem, data_path, meta_path = self._paths(key)
+
+        if len(entry.data) > self.disk_bytes:
+            return
+
+        if changed or not os.path.exists(data_path):
+            tmp_path = data_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(entry.data)
+            os.replace(tmp_path, data_path)
+
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "etag": entry.etag,
+                    "last_modified": entry.last_modified,
+                    "checked": entry.checked,
+                },
+                f,
+            )
+        os.replace(tmp_path, meta_path)
+
+        self._disk_used += len(entry.data) - self._disk.pop(stem, 0)
+        self._disk[stem] = len(entry.data)
+
+        while self._disk_used > self.disk_bytes:
+            evicted, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            self.stats["disk_evictions"] += 1
+            for suffix in (".bin", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, evicted + suffix))
+                except OSError:
+                    pass
+
+    def summary(self):
+
+        return (
+            f"Template cache: {self.stats['memory_hits']} memory hits, "
+            f"{self.stats['disk_hits']} disk hits, "
+            f"{self.stats['revalidated']} revalidated, "
+            f"{self.stats['misses']} misses, "
+            f"{self._memory_used} bytes in memory, "
+            f"{self._disk_used} bytes on disk"
+        )
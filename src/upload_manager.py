@@ -0,0 +1,78 @@
+import asyncio
+import os
+from azure.core.exceptions import AzureError, HttpResponseError
+from azure.storage.blob import ContentSettings
+from blob_store import BlobRef, get_blob_service
+from logging_utility import log_function
+
+
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+# Parallel block uploads within one large blob
+UPLOAD_BLOCK_CONCURRENCY = int(os.getenv("UPLOAD_BLOCK_CONCURRENCY", "4"))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "4"))
+UPLOAD_BACKOFF_SECS = float(os.getenv("UPLOAD_BACKOFF_SECS", "0.5"))
+NON_RETRYABLE_STATUS = (400, 401, 403, 404, 409, 412, 413)
+
+
+class UploadManager:
+
+    def __init__(self, concurrency=UPLOAD_CONCURRENCY):
+
+        self._slots = asyncio.Semaphore(concurrency)
+        self._pending = set()
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, container_name, blob_name, data,
+               content_type="application/octet-stream"):
+
+        task = asyncio.create_task(
+            self._upload(container_name, blob_name, data, content_type)
+        )
+        self._pending.add(task)
+        task.add_done_callback(self._done)
+
+        return BlobRef(container_name, blob_name, len(data), task)
+
+    def _done(self, task):
+
+        self._pending.discard(task)
+        if task.cancelled() or task.exception() is not None:
+            self.failed += 1
+        else:
+            self.completed += 1
+
+    async def _upload(self, container_name, blob_name, data, content_type):
+
+        blob_client = get_blob_service().get_blob_client(
+            container_name, blob_name
+        )
+
+        async with self._slots:
+            for attempt in range(UPLOAD_RETRIES):
+                try:
+                    return await blob_client.upload_blob(
+                        data=data,
+                        overwrite=True,
+                        content_settings=ContentSettings(
+                            content_type=content_type
+                        ),
+                        max_concurrency=UPLOAD_BLOCK_CONCURRENCY,
+                    )
+                except AzureError as e:
+                    if (
+                        isinstance(e, HttpResponseError)
+                        and e.status_code in NON_RETRYABLE_STATUS
+                    ) or attempt == UPLOAD_RETRIES - 1:
+                        log_function(f"Upload failed: {blob_name}: {e}")
+                        raise
+                    await asyncio.sleep(UPLOAD_BACKOFF_SECS * 2 ** attempt)
+
+    async def drain(self):
+
+        if self._pending:
+            log_function(f"Draining {len(self._pending)} uploads")
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+
+uploads = UploadManager()
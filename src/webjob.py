@@ -0,0 +1,10 @@
+import asyncio
+
+
+if __name__ == "__main__":
+
+    # Spawned image workers re-run the launched script as __mp_main__;
+    # keeping it this thin spares them the webjob's imports and stores
+    from async_webjob import main
+
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from logging_utility import log_function
+
+
+class WorkerPool:
+
+    def __init__(self, size):
+
+        self.size = size
+        self.in_use = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self._slots = asyncio.Semaphore(size)
+        self._tasks = set()
+        self._busy = 0.0
+        self._changed = time.monotonic()
+
+    def _account(self, delta):
+
+        now = time.monotonic()
+        self._busy += self.in_use * (now - self._changed)
+        self._changed = now
+        self.in_use += delta
+
+    async def reserve(self, n=1):
+
+        # Wait for one free slot, then take up to n without waiting again
+        await self._slots.acquire()
+        taken = 1
+        while taken < n and not self._slots.locked():
+            await self._slots.acquire()
+            taken += 1
+
+        self._account(taken)
+        return taken
+
+    def release(self, n=1):
+
+        for _ in range(n):
+            self._slots.release()
+        self._account(-n)
+
+    def spawn(self, coro):
+
+        # The caller must already hold a slot from reserve()
+        task = asyncio.create_task(coro)
+        self.started += 1
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+
+        self._tasks.discard(task)
+        if task.cancelled() or task.exception() is not None:
+            self.failed += 1
+        else:
+            self.completed += 1
+        self.release()
+
+    def utilization(self):
+
+        return self.in_use / self.size
+
+    async def report(self, interval):
+
+        while True:
+            self._account(0)
+            self._busy = 0.0
+            await asyncio.sleep(interval)
+            self._account(0)
+            average = self._busy / (interval * self.size)
+            log_function(
+                f"Pool: {self.in_use}/{self.size} busy, "
+                f"{average:.0%} average utilization, "
+                f"{self.started} started, {self.completed} completed, "
+                f"{self.failed} failed"
+            )
+
+    async def drain(self):
+
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)